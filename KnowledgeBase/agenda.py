@@ -0,0 +1,102 @@
+import heapq
+from collections import deque
+from logical_classes import Fact
+
+FIFO = 'fifo'
+LIFO = 'lifo'
+PRIORITY = 'priority'
+
+class Agenda(object):
+    """Facts and rules inferred by forward chaining and waiting to be added to
+        a KnowledgeBase. Adding one of them may infer more, which are pushed
+        here instead of being added recursively, so the depth of a derivation
+        chain is only bounded by memory.
+
+    Attributes:
+        strategy (str): order in which pending items are added, one of
+            'lifo' (depth-first, the default), 'fifo' (breadth-first) or
+            'priority' (lowest priority of the item's predicate first, then FIFO).
+            Depth-first adds the items inferred from one addition in the order
+            they were inferred, like the former recursive forward chaining
+        priority (dictof int|callable): for the 'priority' strategy, either a
+            dict from predicate to priority (missing predicates get 0) or a
+            function of the Fact|Rule returning its priority
+    """
+    def __init__(self, strategy=LIFO, priority=None):
+        """Constructor for Agenda
+
+        Args:
+            strategy (str): 'lifo', 'fifo' or 'priority'
+            priority (dictof int|callable|None): priorities for 'priority'
+        """
+        super(Agenda, self).__init__()
+        if strategy not in (FIFO, LIFO, PRIORITY):
+            raise ValueError("Unknown agenda strategy: {!r}".format(strategy))
+        self.strategy = strategy
+        self.priority = priority if priority is not None else {}
+        self._items = [] if strategy == PRIORITY else deque()
+        self._pushed = []
+        self._count = 0
+
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return 'Agenda({!r}, {} pending)'.format(self.strategy, len(self))
+
+    def __len__(self):
+        """Define behavior of len, i.e. number of pending items
+        """
+        return len(self._items) + len(self._pushed)
+
+    def _priority_of(self, fact_rule):
+        """INTERNAL USE ONLY
+        Priority of a pending item, keyed by the predicate of a fact or of the
+        RHS of a rule
+        """
+        if callable(self.priority):
+            return self.priority(fact_rule)
+        statement = fact_rule.statement if isinstance(fact_rule, Fact) else fact_rule.rhs
+        return self.priority.get(statement.predicate, 0)
+
+    def push(self, fact_rule):
+        """Add an item to the agenda
+
+        Args:
+            fact_rule (Fact|Rule): inferred fact or rule to add to the KB
+        """
+        if self.strategy == PRIORITY:
+            # the counter keeps items of equal priority in FIFO order
+            self._count += 1
+            heapq.heappush(self._items,
+                           (self._priority_of(fact_rule), self._count, fact_rule))
+        elif self.strategy == FIFO:
+            self._items.append(fact_rule)
+        else:
+            self._pushed.append(fact_rule)
+
+    def pop(self):
+        """Remove and return the next item according to the strategy
+
+        Returns:
+            Fact|Rule
+        """
+        if self.strategy == PRIORITY:
+            return heapq.heappop(self._items)[2]
+        if self.strategy == FIFO:
+            return self._items.popleft()
+        if self._pushed:
+            # items pushed since the last pop go on the stack in reverse, so
+            # that the first one pushed is the first one popped
+            self._pushed.reverse()
+            self._items.extend(self._pushed)
+            self._pushed = []
+        return self._items.pop()
+
+    def clear(self):
+        """Drop every pending item
+        """
+        if self.strategy == PRIORITY:
+            self._items = []
+        else:
+            self._items.clear()
+            self._pushed = []
@@ -1,18 +1,65 @@
-import read, copy
+import os, time, read, copy
+import multiprocessing
 from util import *
 from logical_classes import *
+from store import FactStore
+from agenda import Agenda
+import snapshot, wal
+from locks import ReadWriteLock, reading, writing
 
 verbose = 0
 
 class KnowledgeBase(object):
-    def __init__(self, facts=[], rules=[]):
-        self.facts = facts
+    def __init__(self, facts=[], rules=[], engine=None, agenda=None, log=None):
+        """Constructor for KnowledgeBase
+
+        Args:
+            facts (listof Fact): facts the KB starts with
+            rules (listof Rule): rules the KB starts with
+            engine (InferenceEngine|ReteEngine|None): forward chainer notified of
+                every fact/rule added to or removed from the KB, defaults to
+                InferenceEngine
+            agenda (Agenda|None): queue of inferred facts/rules waiting to be
+                added, defaults to a depth-first Agenda
+            log (wal.WriteAheadLog|None): log every assert and retract is
+                appended to, see `recover`
+        """
+        self._lock = ReadWriteLock()
+        self._facts = FactStore(facts)
         self.rules = rules
-        self.ie = InferenceEngine()
+        self.ie = engine if engine is not None else InferenceEngine()
+        self.agenda = agenda if agenda is not None else Agenda()
+        self.log = log
+        self._chaining = False
+
+    @property
+    @reading
+    def facts(self):
+        """listof Fact: facts of the KB in insertion order"""
+        return list(self._facts)
+
+    @facts.setter
+    def facts(self, facts):
+        self._facts = FactStore(facts)
+
+    @property
+    @reading
+    def rules(self):
+        """listof Rule: rules of the KB in insertion order"""
+        return list(self._rules)
+
+    @rules.setter
+    def rules(self, rules):
+        self._rules = rules
+        self._rule_index = {}
+        self._triggers = {}
+        for rule in rules:
+            self._index_rule(rule)
 
     def __repr__(self):
         return 'KnowledgeBase({!r}, {!r})'.format(self.facts, self.rules)
 
+    @reading
     def __str__(self):
         string = "Knowledge Base: \n"
         string += "\n".join((str(fact) for fact in self.facts)) + "\n"
@@ -29,9 +76,7 @@ class KnowledgeBase(object):
         Returns:
             Fact: matching fact
         """
-        for kbfact in self.facts:
-            if fact == kbfact:
-                return kbfact
+        return self._facts.get(fact)
 
     def _get_rule(self, rule):
         """INTERNAL USE ONLY
@@ -43,45 +88,296 @@ class KnowledgeBase(object):
         Returns:
             Rule: matching rule
         """
-        for kbrule in self.rules:
-            if rule == kbrule:
-                return kbrule
+        return self._rule_index.get(rule)
 
+    def _index_rule(self, rule):
+        """INTERNAL USE ONLY
+        Index a stored rule by itself (dedup and lookup) and by the predicate
+        and length of its first LHS statement (trigger index)
+        """
+        self._rule_index.setdefault(rule, rule)
+        first = rule.lhs[0].key
+        self._triggers.setdefault((first[0], len(first)), IdentitySet()).add(rule)
+
+    def _unindex_rule(self, rule):
+        """INTERNAL USE ONLY
+        Remove a rule from the rule indexes
+        """
+        if self._rule_index.get(rule) is rule:
+            del self._rule_index[rule]
+        first = rule.lhs[0].key
+        trigger = (first[0], len(first))
+        rules = self._triggers.get(trigger)
+        if rules is not None:
+            rules.discard(rule)
+            if not rules:
+                del self._triggers[trigger]
+
+    def _rules_triggered_by(self, statement):
+        """INTERNAL USE ONLY
+        Rules whose first LHS statement has the predicate and length of the
+        given statement, i.e. the only ones a fact with that statement can
+        match, in insertion order
+
+        Args:
+            statement (Statement): statement of a fact
+
+        Returns:
+            iterable of Rule
+        """
+        key = statement.key
+        return self._triggers.get((key[0], len(key)), ())
+
+    @writing
     def kb_add(self, fact_rule):
-        """Add a fact or rule to the KB
+        """Add a fact or rule to the KB. While forward chaining is running the
+            fact or rule is only pushed on the agenda, otherwise it is added and
+            the agenda is run until every inference has been added.
+
         Args:
             fact_rule (Fact|Rule) - the fact or rule to be added
         Returns:
             None
         """
+        self.agenda.push(fact_rule)
+        if not self._chaining:
+            self._run_agenda()
+
+    def _run_agenda(self):
+        """INTERNAL USE ONLY
+        Add the items of the agenda until it is empty
+        """
+        self._chaining = True
+        try:
+            while self.agenda:
+                self._add(self.agenda.pop())
+        except:
+            self.agenda.clear()
+            raise
+        finally:
+            self._chaining = False
+
+    def _add(self, fact_rule):
+        """INTERNAL USE ONLY
+        Store a fact or rule, or merge it into the equal one already stored, and
+        let the inference engine infer from it if it is new
+
+        Args:
+            fact_rule (Fact|Rule) - the fact or rule to be added
+        """
         printv("Adding {!r}", 1, verbose, [fact_rule])
+        if self._store(fact_rule):
+            if isinstance(fact_rule, Fact):
+                self.ie.fact_added(fact_rule, self)
+            else:
+                self.ie.rule_added(fact_rule, self)
+
+    def _store(self, fact_rule):
+        """INTERNAL USE ONLY
+        Store a fact or rule without inferring from it. If an equal one is
+        already stored, merge the supports (or the asserted flag) into it.
+
+        Args:
+            fact_rule (Fact|Rule) - the fact or rule to be stored
+
+        Returns:
+            bool: True if fact_rule was not in the KB and has been stored
+        """
         if isinstance(fact_rule, Fact):
-            if fact_rule not in self.facts:
-                self.facts.append(fact_rule)
-                for rule in self.rules:
-                    self.ie.fc_infer(fact_rule, rule, self)
+            kbfact = self._facts.get(fact_rule)
+            if kbfact is None:
+                self._facts.add(fact_rule)
+                self._link(fact_rule, fact_rule.supported_by)
+                return True
             else:
                 if fact_rule.supported_by:
-                    ind = self.facts.index(fact_rule)
                     for f in fact_rule.supported_by:
-                        self.facts[ind].supported_by.append(f)
+                        if kbfact.supported_by.add(f):
+                            self._link(kbfact, [f])
                 else:
-                    ind = self.facts.index(fact_rule)
-                    self.facts[ind].asserted = True
+                    kbfact.asserted = True
         elif isinstance(fact_rule, Rule):
-            if fact_rule not in self.rules:
-                self.rules.append(fact_rule)
-                for fact in self.facts:
-                    self.ie.fc_infer(fact, fact_rule, self)
+            kbrule = self._rule_index.get(fact_rule)
+            if kbrule is None:
+                self._rules.append(fact_rule)
+                self._index_rule(fact_rule)
+                self._link(fact_rule, fact_rule.supported_by)
+                return True
             else:
                 if fact_rule.supported_by:
-                    ind = self.rules.index(fact_rule)
                     for f in fact_rule.supported_by:
-                        self.rules[ind].supported_by.append(f)
+                        if kbrule.supported_by.add(f):
+                            self._link(kbrule, [f])
                 else:
-                    ind = self.rules.index(fact_rule)
-                    self.rules[ind].asserted = True
+                    kbrule.asserted = True
+        return False
+
+    def _flush_agenda(self):
+        """INTERNAL USE ONLY
+        Store every item of the agenda without inferring from it
+
+        Returns:
+            (listof Fact, listof Rule): the facts and rules that were new
+        """
+        facts, rules = [], []
+        while self.agenda:
+            fact_rule = self.agenda.pop()
+            if self._store(fact_rule):
+                (facts if isinstance(fact_rule, Fact) else rules).append(fact_rule)
+        return facts, rules
+
+    @writing
+    def bulk_load(self, items):
+        """Assert many facts and rules at once: everything is stored first, then
+            the closure is computed by `saturate` instead of inferring from each
+            item as it is asserted. The KB ends up with the same facts, rules and
+            supports as if the items were asserted one by one.
+
+        Args:
+            items (listof Fact|Rule) - facts and rules to assert, e.g. the output
+                of read.read_tokenize; anything else is ignored
+        """
+        printv("Bulk loading {} items", 0, verbose, [len(items)])
+        facts, rules = [], []
+        for item in items:
+            if isinstance(item, Fact) or isinstance(item, Rule):
+                if self.log is not None:
+                    self.log.append(wal.ASSERT, item)
+                if self._store(item):
+                    (facts if isinstance(item, Fact) else rules).append(item)
+        self.saturate(facts, rules)
+
+    @writing
+    def saturate(self, facts=None, rules=None):
+        """Forward chain from facts and rules stored without inference until
+            nothing new can be inferred
+
+        Args:
+            facts (listof Fact|None) - stored facts nothing was inferred from yet,
+                defaults to every fact of the KB
+            rules (listof Rule|None) - stored rules nothing was inferred from yet,
+                defaults to every rule of the KB
+        """
+        if facts is None and rules is None:
+            facts, rules = self.facts, self.rules
+        self._chaining = True
+        try:
+            self.ie.saturate(facts or [], rules or [], self)
+            while self.agenda:
+                self._add(self.agenda.pop())
+        except:
+            self.agenda.clear()
+            raise
+        finally:
+            self._chaining = False
+
+    @reading
+    def save(self, path):
+        """Save the facts, rules and supports of the KB to a binary snapshot,
+            see `snapshot.save_snapshot`
+
+        Args:
+            path (str): name of the snapshot file
+        """
+        printv("Saving to {}", 0, verbose, [path])
+        snapshot.save_snapshot(self, path)
+
+    @classmethod
+    def load(cls, path, engine=None, agenda=None):
+        """Create a KB from a snapshot written by `save`. Nothing is inferred:
+            facts, rules and supports are restored as they were saved.
+
+        Args:
+            path (str): name of the snapshot file
+            engine (InferenceEngine|ReteEngine|None): engine of the new KB
+            agenda (Agenda|None): agenda of the new KB
+
+        Returns:
+            KnowledgeBase
+        """
+        printv("Loading {}", 0, verbose, [path])
+        kb = cls([], [], engine=engine, agenda=agenda)
+        snapshot.load_snapshot(kb, path)
+        return kb
 
+    @reading
+    def snapshot(self):
+        """Read-only view of the KB as it is now, unaffected by later asserts
+            and retracts. Taking it is O(1), nothing is copied: the fact store
+            keeps the versions at which each fact was added and removed, and
+            the list of rules is only appended to (removing rules replaces it).
+            The facts and rules themselves are shared with the KB, so their
+            `asserted` flags and supports are the current ones.
+
+        Returns:
+            KnowledgeBaseView
+        """
+        return KnowledgeBaseView(self._facts.view(), self._rules)
+
+    @writing
+    def checkpoint(self, path):
+        """Save a snapshot of the KB, then empty its log since the snapshot
+            holds everything the log recorded. The snapshot is written to a
+            temporary file first so that a crash leaves the previous one intact,
+            and both the file and the rename are made durable before the log is
+            emptied, so that a power loss cannot lose both.
+
+        Args:
+            path (str): name of the snapshot file
+        """
+        temporary = path + '.tmp'
+        self.save(temporary)
+        with open(temporary, 'rb') as f:
+            os.fsync(f.fileno())
+        os.replace(temporary, path)
+        directory = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+        if self.log is not None:
+            self.log.truncate()
+
+    @classmethod
+    def recover(cls, path, log_path, engine=None, agenda=None):
+        """Rebuild a KB after a crash: load the snapshot written by the last
+            `checkpoint` (if any), then replay the log written since. Runs of
+            consecutive asserts are applied at once through `bulk_load`, and
+            runs of retracts through `kb_retract_many`. A torn record at the end
+            of the log is dropped. The log is then attached to the new KB.
+
+        Args:
+            path (str): name of the snapshot file
+            log_path (str): name of the log file
+            engine (InferenceEngine|ReteEngine|None): engine of the new KB
+            agenda (Agenda|None): agenda of the new KB
+
+        Returns:
+            KnowledgeBase
+        """
+        if os.path.exists(path):
+            kb = cls.load(path, engine=engine, agenda=agenda)
+        else:
+            kb = cls([], [], engine=engine, agenda=agenda)
+        log = wal.WriteAheadLog(log_path)
+        records = log.records()
+        printv("Replaying {} records from {}", 0, verbose, [len(records), log_path])
+        start = 0
+        while start < len(records):
+            operation = records[start][0]
+            end = start
+            while end < len(records) and records[end][0] == operation:
+                end += 1
+            batch = [item for _, item in records[start:end]]
+            if operation == wal.ASSERT:
+                kb.bulk_load(batch)
+            else:
+                kb.kb_retract_many(batch)
+            start = end
+        kb.log = log
+        return kb
+
+    @writing
     def kb_assert(self, fact_rule):
         """Assert a fact or rule into the KB
 
@@ -89,26 +385,65 @@ class KnowledgeBase(object):
             fact_rule (Fact or Rule): Fact or Rule we're asserting
         """
         printv("Asserting {!r}", 0, verbose, [fact_rule])
+        if self.log is not None:
+            self.log.append(wal.ASSERT, fact_rule)
         self.kb_add(fact_rule)
 
-    def kb_ask(self, fact):
+    def _assert_steps(self, fact_rule, steps, budget=None):
+        """INTERNAL USE ONLY
+        Assert a fact or rule like kb_assert, as a generator running forward
+        chaining in slices: it yields whenever `steps` items of the agenda were
+        added or `budget` seconds went by, until the closure is complete. The
+        write lock is held throughout; closing the generator before the end
+        completes the closure at once.
+        """
+        self._lock.acquire_write()
+        try:
+            printv("Asserting {!r}", 0, verbose, [fact_rule])
+            if self.log is not None:
+                self.log.append(wal.ASSERT, fact_rule)
+            self.agenda.push(fact_rule)
+            self._chaining = True
+            try:
+                while self.agenda:
+                    deadline = time.monotonic() + budget if budget is not None else None
+                    for _ in range(steps):
+                        self._add(self.agenda.pop())
+                        if not self.agenda or (deadline is not None and time.monotonic() >= deadline):
+                            break
+                    if self.agenda:
+                        try:
+                            yield
+                        except GeneratorExit:
+                            while self.agenda:
+                                self._add(self.agenda.pop())
+                            raise
+            except:
+                self.agenda.clear()
+                raise
+            finally:
+                self._chaining = False
+        finally:
+            self._lock.release_write()
+
+    @reading
+    def kb_ask(self, fact, limit=None, offset=0):
         """Ask if a fact is in the KB
 
         Args:
             fact (Fact) - Statement to be asked (will be converted into a Fact)
+            limit (int|None) - return at most this many bindings, None for all
+            offset (int) - number of matching facts to skip first, to page
+                through the answers together with limit
 
         Returns:
             listof Bindings|False - list of Bindings if result found, False otherwise
         """
-        print("Asking {!r}".format(fact))
+        printv("Asking {!r}", 0, verbose, [fact])
         if factq(fact):
-            f = Fact(fact.statement)
             bindings_lst = ListOfBindings()
-            # ask matched facts
-            for fact in self.facts:
-                binding = match(f.statement, fact.statement)
-                if binding:
-                    bindings_lst.add_bindings(binding, [fact])
+            for bindings, facts in self._answers(fact.statement, limit, offset):
+                bindings_lst.add_bindings(bindings, facts)
 
             return bindings_lst if bindings_lst.list_of_bindings else []
 
@@ -116,8 +451,151 @@ class KnowledgeBase(object):
             print("Invalid ask:", fact.statement)
             return []
 
+    def kb_ask_iter(self, fact, limit=None, offset=0):
+        """Lazily yield the answers to a query, in the order kb_ask returns
+            them. Only indexed candidate facts are matched and nothing is
+            computed ahead of the answer being yielded, so the first answer
+            comes back without scanning the KB.
+
+        Args:
+            fact (Fact|Statement) - Statement to be asked
+            limit (int|None) - yield at most this many answers, None for all
+            offset (int) - number of answers to skip first
+
+        Yields:
+            (Bindings, listof Fact) - bindings of the query's variables and the
+                matching fact
+        """
+        answers = self._answers(fact.statement if factq(fact) else fact, limit, offset)
+        while True:
+            # the lock is only held while looking for the next answer, so each
+            # answer comes from a complete closure but a write may happen
+            # between two answers; kb_ask reads all of them at once instead
+            self._lock.acquire_read()
+            try:
+                answer = next(answers, None)
+            finally:
+                self._lock.release_read()
+            if answer is None:
+                return
+            yield answer
+
+    def _answers(self, statement, limit, offset):
+        """INTERNAL USE ONLY
+        Generate the answers of kb_ask_iter, without locking
+        """
+        if limit is not None and limit <= 0:
+            return
+        for kbfact in self._facts.candidates(statement):
+            bindings = match(statement, kbfact.statement)
+            if not bindings:
+                continue
+            if offset > 0:
+                offset -= 1
+                continue
+            yield bindings, [kbfact]
+            if limit is not None:
+                limit -= 1
+                if limit == 0:
+                    return
+
+    @reading
+    def kb_ask_conjunction(self, statements):
+        """Ask which bindings satisfy several statements at once, e.g.
+            [(inst ?x pyramid), (color ?x red)]. Statements are joined from the
+            most selective one, estimated from the fact index, each next one
+            sharing a variable with those already joined when possible, using
+            hash joins on the shared variables.
+
+        Args:
+            statements (listof Statement|Fact) - the conjunction to be asked
+
+        Returns:
+            ListOfBindings|[] - bindings of every variable of the statements, in
+                order of first occurrence, with the facts matching each statement
+                in the order of the statements; [] if there is no answer
+        """
+        statements = [s.statement if factq(s) else s for s in statements]
+        printv("Asking conjunction {!r}", 0, verbose, [statements])
+        if not statements:
+            return []
+        patterns = [compile_pattern(s) for s in statements]
+        variables = []
+        for pattern in patterns:
+            variables.extend(v for v in pattern.variables if v not in variables)
+        slot_of = dict((v.id, i) for i, v in enumerate(variables))
+
+        # rows are (values, facts): values indexed like `variables` (None until
+        # bound) and facts indexed like `statements`
+        rows = [([None] * len(variables), [None] * len(statements))]
+        bound = set()
+        for index in self._plan_conjunction(statements, patterns):
+            pattern = patterns[index]
+            slots = [slot_of[v.id] for v in pattern.variables]
+            shared = [i for i, slot in enumerate(slots) if slot in bound]
+            table = {}
+            for kbfact in self._facts.candidates(statements[index]):
+                key = kbfact.statement.key
+                if len(key) == 1 or min(key[1:]) >= 0:
+                    values = pattern.match(key)
+                else:
+                    # a fact holding a variable is unified with the statement
+                    bindings = match(statements[index], kbfact.statement)
+                    values = tuple(bindings.bound_id(v.id) for v in pattern.variables) if bindings else None
+                if values is not None:
+                    key = tuple(values[i] for i in shared)
+                    table.setdefault(key, []).append((values, kbfact))
+            joined = []
+            for row_values, row_facts in rows:
+                key = tuple(row_values[slots[i]] for i in shared)
+                for values, kbfact in table.get(key, ()):
+                    new_values = list(row_values)
+                    for i, slot in enumerate(slots):
+                        new_values[slot] = values[i]
+                    new_facts = list(row_facts)
+                    new_facts[index] = kbfact
+                    joined.append((new_values, new_facts))
+            rows = joined
+            if not rows:
+                return []
+            bound.update(slots)
+
+        bindings_lst = ListOfBindings()
+        variables = tuple(variables)
+        for row_values, row_facts in rows:
+            bindings_lst.add_bindings(Bindings(variables, row_values, slot_of), row_facts)
+        return bindings_lst
+
+    def _plan_conjunction(self, statements, patterns):
+        """INTERNAL USE ONLY
+        Order in which to join the statements of a conjunction: greedily the
+        statement with the fewest candidate facts, among those sharing a
+        variable with the statements already joined if there are any
+
+        Returns:
+            listof int: indexes of the statements
+        """
+        estimates = [self._facts.estimate(s) for s in statements]
+        remaining = list(range(len(statements)))
+        bound = set()
+        order = []
+        while remaining:
+            connected = [i for i in remaining
+                         if any(v.id in bound for v in patterns[i].variables)]
+            best = min(connected or remaining, key=lambda i: estimates[i])
+            remaining.remove(best)
+            order.append(best)
+            bound.update(v.id for v in patterns[best].variables)
+        return order
+
+    @writing
     def kb_retract(self, fact_or_rule):
-        """Retract a fact from the KB
+        """Retract a fact from the KB. The fact is removed only if no other
+            facts and rules support it; otherwise it just stops being asserted.
+            Truth maintenance then removes every fact and rule that was inferred
+            from it and is neither supported otherwise nor asserted. Retracting
+            a rule removes it along with the rules curried from it that are not
+            supported otherwise; the facts it inferred are kept.
 
         Args:
             fact (Fact) - Fact to be retracted
@@ -126,74 +604,447 @@ class KnowledgeBase(object):
             None
         """
         printv("Retracting {!r}", 0, verbose, [fact_or_rule])
-        if len(fact_or_rule.supported_by) != 0:
-            return None
-        
-        #if rule
-        if isinstance(fact_or_rule, Rule):
-            if fact_or_rule in self.rules and len(fact_or_rule.supported_by) == 0:  
-                self.rules.remove(fact_or_rule)
-                
-        #if fact
-        if isinstance(fact_or_rule, Fact): 
-            flag = False
-            for x in self.facts:
-                if fact_or_rule.statement == x.statement:
-                    fact_or_rule = x
-                    flag = True
-                    break
-            if flag == False:
-                return None
-            if len(fact_or_rule.supported_by) == 0:  
-                self.facts.remove(fact_or_rule)
-            
-
-        #search all the supports_facts
-        for temp in fact_or_rule.supports_facts:
-            #if temp.asserted == True:
-            #    continue
-            templen = 0
-            standard = len(temp.supported_by)
-            for x in temp.supported_by:
-                if fact_or_rule in x:
-                    temp.supported_by.remove(x)
-                    templen += 1
-            if standard == templen:
-                #temp.supported_by = []
-                self.kb_retract(temp)
-            '''
-            if len(temp.supported_by) == 1:
-                self.kb_retract(temp)
+        self._retract([fact_or_rule])
+
+    @writing
+    def kb_retract_many(self, facts_rules):
+        """Retract many facts and rules at once, e.g. every fact about a deleted
+            entity. Each one is retracted as by `kb_retract`, but what is left
+            unsupported is computed once for all of them and removed from the
+            KB in bulk.
+
+        Args:
+            facts_rules (listof Fact|Rule) - facts and rules to be retracted
+
+        Returns:
+            None
+        """
+        printv("Retracting {} items", 0, verbose, [len(facts_rules)])
+        self._retract(facts_rules)
+
+    def _retract(self, facts_rules):
+        """INTERNAL USE ONLY
+        Retract facts and rules: unassert the supported ones, then remove the
+        others along with what only they support
+        """
+        seeds = []
+        seen = set()
+        for fact_or_rule in facts_rules:
+            if len(fact_or_rule.supported_by) != 0:
+                continue
+            if isinstance(fact_or_rule, Fact):
+                kbitem = self._facts.get(fact_or_rule)
+            elif isinstance(fact_or_rule, Rule):
+                kbitem = self._get_rule(fact_or_rule)
             else:
-                for pair in temp.supported_by:
-                    if pair[0] == fact_or_rule or pair[1] == fact_or_rule:
-                        temp.supported_by.remove(pair)
-                        print('remove supported_by', temp, pair)
-            '''
-        #search all the supports_rules
-        for temp in fact_or_rule.supports_rules:
-            templen = 0
-            standard = len(temp.supported_by)
-            for y in temp.supported_by:
-                if fact_or_rule in y:
-                    temp.supported_by.remove(y)
-                    templen += 1
-            if standard == templen:
-                #temp.supported_by = []
-                self.kb_retract(temp)
-            '''
-            if len(temp.supported_by) == 1:
-                self.rules.remove(temp)
-                print('remove rule', temp)
+                continue
+            if kbitem is None or id(kbitem) in seen:
+                continue
+            seen.add(id(kbitem))
+            if self.log is not None:
+                self.log.append(wal.RETRACT, kbitem)
+            if kbitem.supported_by:
+                kbitem.asserted = False
             else:
-                for pair in temp.supported_by:
-                    if pair[0] == fact_or_rule or pair[1] == fact_or_rule:
-                        temp.supported_by.remove(pair)
-                        print('remove supported_by', temp, pair)
-            '''
-        
+                seeds.append(kbitem)
+        facts = [seed for seed in seeds if isinstance(seed, Fact)]
+        rules = [seed for seed in seeds if isinstance(seed, Rule)]
+        closure = self._unsupported_closure(facts)
+        # the rules curried from a retracted rule go with it, but the facts it
+        # inferred are kept
+        gone = set(id(fact_rule) for fact_rule in closure)
+        closure.extend(fact_rule for fact_rule in self._unsupported_closure(rules, False)
+                       if id(fact_rule) not in gone)
+        self._remove_all(seeds + closure)
+
+    def _unsupported_closure(self, removed, facts=True):
+        """INTERNAL USE ONLY
+        Truth maintenance for facts or rules about to be removed: drop the
+        justifications they take part in, and collect whatever is left without
+        justification and is not asserted, then what only those support, and
+        so on. A worklist is used instead of recursion, and only the facts and
+        rules the removed ones support are visited.
+
+        Args:
+            removed (listof Fact|Rule) - facts and rules being removed
+            facts (bool) - if False, only the rules they support are visited
+
+        Returns:
+            listof Fact|Rule: the facts and rules to remove along with them
+        """
+        gone = set(id(fact_rule) for fact_rule in removed)
+        worklist = list(removed)
+        closure = []
+        while worklist:
+            fact_rule = worklist.pop()
+            dependents = list(fact_rule.supports_rules)
+            if facts:
+                dependents = list(fact_rule.supports_facts) + dependents
+            for dependent in dependents:
+                if id(dependent) in gone:
+                    continue
+                dead = [justification for justification in dependent.supported_by
+                        if any(id(x) in gone for x in justification)]
+                for justification in dead:
+                    dependent.supported_by.discard(justification)
+                for justification in dead:
+                    self._unlink(dependent, justification)
+                if not dependent.supported_by and not dependent.asserted:
+                    gone.add(id(dependent))
+                    closure.append(dependent)
+                    worklist.append(dependent)
+        return closure
+
+    def _remove_all(self, facts_rules):
+        """INTERNAL USE ONLY
+        Remove stored facts and rules in bulk and let the inference engine
+        forget them
+        """
+        if not facts_rules:
+            return
+        printv("Removing {!r}", 1, verbose, [facts_rules])
+        facts = [x for x in facts_rules if isinstance(x, Fact)]
+        rules = set(id(x) for x in facts_rules if isinstance(x, Rule))
+        self._facts.remove_many(facts)
+        if rules:
+            # a new list, so that views keep the old one (see `snapshot`)
+            self._rules = [rule for rule in self._rules if id(rule) not in rules]
+            for fact_rule in facts_rules:
+                if isinstance(fact_rule, Rule):
+                    self._unindex_rule(fact_rule)
+        for fact_rule in facts_rules:
+            if isinstance(fact_rule, Fact):
+                self.ie.fact_removed(fact_rule, self)
+            else:
+                self.ie.rule_removed(fact_rule, self)
+
+    def _link(self, fact_rule, justifications):
+        """INTERNAL USE ONLY
+        Record a stored fact or rule in the supports lists of the facts and
+        rules of its justifications
+        """
+        for justification in justifications:
+            for supporter in justification:
+                if isinstance(fact_rule, Fact):
+                    supporter.supports_facts.add(fact_rule)
+                else:
+                    supporter.supports_rules.add(fact_rule)
+
+    def _unlink(self, fact_rule, justification):
+        """INTERNAL USE ONLY
+        Remove a fact or rule from the supports lists of the facts and rules of
+        one of its dropped justifications, unless it still has another
+        justification involving them
+        """
+        for supporter in justification:
+            if any(supporter is x for other in fact_rule.supported_by for x in other):
+                continue
+            if isinstance(fact_rule, Fact):
+                supporter.supports_facts.discard(fact_rule)
+            else:
+                supporter.supports_rules.discard(fact_rule)
+
+
+class KnowledgeBaseView(object):
+    """Read-only view of a KnowledgeBase returned by `KnowledgeBase.snapshot`,
+        answering `kb_ask`, `kb_ask_iter` and `kb_ask_conjunction` as the KB
+        did when the view was taken
+    """
+    def __init__(self, facts, rules):
+        """Constructor for KnowledgeBaseView
+
+        Args:
+            facts (FactStoreView): view of the fact store
+            rules (listof Rule): list of rules of the KB, of which the view
+                sees the current ones
+        """
+        super(KnowledgeBaseView, self).__init__()
+        self._lock = ReadWriteLock()
+        self._facts = facts
+        self._rules = rules
+        self._count = len(rules)
+
+    @property
+    def version(self):
+        """int: version of the fact store seen by the view"""
+        return self._facts.version
+
+    @property
+    def facts(self):
+        """listof Fact: facts of the view in insertion order"""
+        return list(self._facts)
+
+    @property
+    def rules(self):
+        """listof Rule: rules of the view in insertion order"""
+        return self._rules[:self._count]
+
+    def __repr__(self):
+        return 'KnowledgeBaseView({!r}, {!r})'.format(self.facts, self.rules)
+
+    __str__ = KnowledgeBase.__str__
+    kb_ask = KnowledgeBase.kb_ask
+    kb_ask_iter = KnowledgeBase.kb_ask_iter
+    kb_ask_conjunction = KnowledgeBase.kb_ask_conjunction
+    _answers = KnowledgeBase._answers
+    _plan_conjunction = KnowledgeBase._plan_conjunction
+
 
 class InferenceEngine(object):
+    """Forward chainer currying rules: a fact matching the first LHS statement
+        of a rule yields a new fact, or a new rule made of the rest of the LHS.
+        A KnowledgeBase calls the `*_added`/`*_removed` hooks as its contents
+        change; any object providing them can be used as the engine of a KB.
+
+    Attributes:
+        join_memory (bool): if True, curried rules are kept in a join memory of
+            the engine instead of being added to `kb.rules`, so that adding a
+            fact only tries the curried rules waiting for its predicate. They
+            still support and are supported by facts and rules, and are
+            removed by `kb_retract` like any inferred rule.
+        processes (int|None): number of worker processes `saturate` matches
+            the delta facts of large rounds with, None or 1 to match them in
+            this process
+        min_parallel (int): number of delta facts a round needs to be matched
+            by the worker processes
+    """
+    min_parallel = 4096
+
+    def __init__(self, join_memory=False, processes=None):
+        """Constructor for InferenceEngine
+
+        Args:
+            join_memory (bool): keep curried rules in the engine, see above
+            processes (int|None): see above
+        """
+        super(InferenceEngine, self).__init__()
+        self.join_memory = join_memory
+        self.processes = processes
+        self._partials = {}
+        self._waiting = {}
+
+    def partial_rules(self):
+        """Curried rules of the join memory, in the order they were inferred
+
+        Returns:
+            listof Rule
+        """
+        return list(self._partials.values())
+
+    def fact_added(self, fact, kb):
+        """Infer from a fact just added to the KB and the rules of the KB whose
+            first LHS statement has the predicate and length of its statement
+
+        Args:
+            fact (Fact) - the added fact
+            kb (KnowledgeBase) - the KnowledgeBase it was added to
+        """
+        for rule in kb._rules_triggered_by(fact.statement):
+            self.fc_infer(fact, rule, kb)
+        if self._waiting:
+            for rule in list(self._waiting_for(fact.statement)):
+                self.fc_infer(fact, rule, kb)
+
+    def _waiting_for(self, statement):
+        """INTERNAL USE ONLY
+        Curried rules of the join memory whose first LHS statement has the
+        predicate and length of the given statement
+        """
+        key = statement.key
+        return self._waiting.get((key[0], len(key)), ())
+
+    def _rule_key(self, rule):
+        """INTERNAL USE ONLY
+        Hashable key of the LHS and RHS of a rule
+        """
+        return (tuple(statement.key for statement in rule.lhs), rule.rhs.key)
+
+    def _add_rule(self, rule, kb):
+        """INTERNAL USE ONLY
+        Add a curried rule to the KB or, with a join memory, keep it in the
+        engine: store it or merge its supports into the equal one already
+        there, and infer from it if it is new
+        """
+        if not self.join_memory:
+            kb.kb_add(rule)
+            return
+        key = self._rule_key(rule)
+        partial = self._partials.get(key)
+        if partial is not None:
+            for justification in rule.supported_by:
+                if partial.supported_by.add(justification):
+                    kb._link(partial, [justification])
+            return
+        printv("Keeping {!r}", 1, verbose, [rule])
+        self._keep(rule)
+        kb._link(rule, rule.supported_by)
+        self.rule_added(rule, kb)
+
+    def _keep(self, rule):
+        """INTERNAL USE ONLY
+        Store a curried rule in the join memory
+        """
+        self._partials[self._rule_key(rule)] = rule
+        first = rule.lhs[0].key
+        self._waiting.setdefault((first[0], len(first)), IdentitySet()).add(rule)
+
+    def rule_added(self, rule, kb):
+        """Infer from a rule just added to the KB and the facts matching its
+            first LHS statement
+
+        Args:
+            rule (Rule) - the added rule
+            kb (KnowledgeBase) - the KnowledgeBase it was added to
+        """
+        for fact in kb._facts.candidates(rule.lhs[0]):
+            self.fc_infer(fact, rule, kb)
+
+    def saturate(self, facts, rules, kb):
+        """Semi-naive forward chaining from facts and rules stored in the KB
+            without inference. Each round only tries the (fact, rule) pairs made
+            of at least one item of the round's delta: delta facts with every
+            rule, and delta rules with the other facts. What they infer is
+            stored without inference and becomes the delta of the next round.
+
+        Args:
+            facts (listof Fact) - delta facts of the first round
+            rules (listof Rule) - delta rules of the first round
+            kb (KnowledgeBase) - the KnowledgeBase they are stored in
+        """
+        pool = None
+        try:
+            while facts or rules:
+                printv("Saturating {} facts and {} rules", 1, verbose,
+                    [len(facts), len(rules)])
+                if (self.processes or 1) > 1 and len(facts) >= self.min_parallel:
+                    if pool is None:
+                        pool = self._pool()
+                if pool is not None and len(facts) >= self.min_parallel:
+                    self._infer_parallel(facts, kb, pool)
+                else:
+                    for fact in facts:
+                        for rule in kb._rules_triggered_by(fact.statement):
+                            self.fc_infer(fact, rule, kb)
+                        if self._waiting:
+                            for rule in list(self._waiting_for(fact.statement)):
+                                self.fc_infer(fact, rule, kb)
+                self._infer_rules(rules, facts, kb)
+                facts, rules = kb._flush_agenda()
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+    def _infer_rules(self, rules, facts, kb):
+        """INTERNAL USE ONLY
+        Infer from the delta rules of a round and the facts that are not delta
+        facts of the round
+        """
+        delta = set(id(fact) for fact in facts)
+        for rule in rules:
+            for fact in kb._facts.candidates(rule.lhs[0]):
+                if id(fact) not in delta:
+                    self.fc_infer(fact, rule, kb)
+
+    def _pool(self):
+        """INTERNAL USE ONLY
+        Start the worker processes of `saturate`, None if the platform has no
+        process pools
+        """
+        try:
+            return multiprocessing.Pool(self.processes)
+        except (OSError, ImportError):
+            return None
+
+    def _infer_parallel(self, facts, kb, pool):
+        """INTERNAL USE ONLY
+        Infer from the delta facts of a round like the serial loop of
+        `saturate`, matching them in the worker processes. Ground facts are
+        grouped by the predicate and length of their statement, i.e. by the
+        rules they trigger, and the groups are cut into about one shard per
+        process. A shard is sent as the compiled first LHS statement of its
+        rules and the keys of its facts, all tuples of symbol ids, and comes
+        back as the slot values of every match. The matches are then fired
+        fact by fact in the order of the serial loop, so the same facts, rules
+        and supports are inferred in the same order. Curried rules kept in the
+        join memory during the round are matched here as the loop goes.
+        """
+        groups = {}
+        for index, fact in enumerate(facts):
+            key = fact.statement.key
+            if len(key) == 1 or min(key[1:]) >= 0:
+                groups.setdefault((key[0], len(key)), []).append(index)
+        size = -(-len(facts) // self.processes)
+        candidates = {}
+        shards = []
+        for indexes in groups.values():
+            statement = facts[indexes[0]].statement
+            rules = list(kb._rules_triggered_by(statement)) + list(self._waiting_for(statement))
+            if not rules:
+                continue
+            tried = IdentitySet(rules)
+            patterns = []
+            for rule in rules:
+                first = compile_rule(rule).first
+                patterns.append((first.length, first.constants, first.repeats, first.slots))
+            for start in range(0, len(indexes), size):
+                shard = indexes[start:start + size]
+                for index in shard:
+                    candidates[index] = (rules, tried)
+                shards.append((patterns, [(index, facts[index].statement.key) for index in shard]))
+        matches = {}
+        for shard_matches in pool.imap(_match_shard, shards):
+            for index, position, values in shard_matches:
+                matches.setdefault(index, {})[id(candidates[index][0][position])] = values
+        for index, fact in enumerate(facts):
+            if index not in candidates:
+                for rule in kb._rules_triggered_by(fact.statement):
+                    self.fc_infer(fact, rule, kb)
+                if self._waiting:
+                    for rule in list(self._waiting_for(fact.statement)):
+                        self.fc_infer(fact, rule, kb)
+                continue
+            found = matches.get(index, {})
+            tried = candidates[index][1]
+            for rule in kb._rules_triggered_by(fact.statement):
+                if id(rule) in found:
+                    self._fire(fact, rule, found[id(rule)], kb)
+            if self._waiting:
+                for rule in list(self._waiting_for(fact.statement)):
+                    if id(rule) in found:
+                        self._fire(fact, rule, found[id(rule)], kb)
+                    elif rule not in tried:
+                        self.fc_infer(fact, rule, kb)
+
+    def restore(self, kb):
+        """Rebuild the engine state after the KB was restored from a snapshot.
+            Curried rules keep no state besides the join memory, which the
+            snapshot restores itself.
+
+        Args:
+            kb (KnowledgeBase) - the restored KnowledgeBase
+        """
+
+    def fact_removed(self, fact, kb):
+        """Forget a fact removed from the KB, curried rules keep no state"""
+
+    def rule_removed(self, rule, kb):
+        """Forget a rule removed from the KB, dropping it from the join memory
+            if it is a curried rule kept there
+
+        Args:
+            rule (Rule) - the removed rule
+            kb (KnowledgeBase) - the KnowledgeBase it was removed from
+        """
+        if self._partials:
+            key = self._rule_key(rule)
+            if self._partials.get(key) is rule:
+                del self._partials[key]
+                waiting = self._waiting_for(rule.lhs[0])
+                waiting.discard(rule)
+                if not waiting:
+                    first = rule.lhs[0].key
+                    del self._waiting[(first[0], len(first))]
+
     def fc_infer(self, fact, rule, kb):
         """Forward-chaining to infer new facts and rules
 
@@ -207,6 +1058,15 @@ class InferenceEngine(object):
         """
         printv('Attempting to infer from {!r} and {!r} => {!r}', 1, verbose,
             [fact.statement, rule.lhs, rule.rhs])
+        key = fact.statement.key
+        first = rule.lhs[0].key
+        if len(first) != len(key) or first[0] != key[0]:
+            return None
+        if len(key) == 1 or min(key[1:]) >= 0:
+            values = compile_rule(rule).first.match(key)
+            if values is not None:
+                self._fire(fact, rule, values, kb)
+            return None
         #get bingdings
         bindings = match(rule.lhs[0], fact.statement)
         if bindings == False:
@@ -214,8 +1074,6 @@ class InferenceEngine(object):
         #only one lhs
         if len(rule.lhs) == 1:
             newfact = Fact(instantiate(rule.rhs, bindings), [[rule, fact]])
-            rule.supports_facts.append(newfact)
-            fact.supports_facts.append(newfact)
             kb.kb_add(newfact)
         #more than one lhs
         else:
@@ -226,6 +1084,50 @@ class InferenceEngine(object):
             localrule.append(locallhs)
             localrule.append(instantiate(rule.rhs, bindings))
             newrule = Rule(localrule,[[rule, fact]])
-            rule.supports_rules.append(newrule)
-            fact.supports_rules.append(newrule)
-            kb.kb_add(newrule)
\ No newline at end of file
+            self._add_rule(newrule, kb)
+
+    def _fire(self, fact, rule, values, kb):
+        """INTERNAL USE ONLY
+        Infer from a ground fact and a rule, given the values the fact binds to
+        the first slots of the compiled rule: fill its templates into a new
+        fact, or into a new rule made of the rest of the LHS
+        """
+        compiled = compile_rule(rule)
+        if len(rule.lhs) == 1:
+            newfact = Fact(compiled.statement(compiled.rhs, values), [[rule, fact]])
+            kb.kb_add(newfact)
+        else:
+            newrule = Rule(compiled.curry(values), [[rule, fact]])
+            self._add_rule(newrule, kb)
+
+
+def _match_shard(shard):
+    """INTERNAL USE ONLY
+    Match a shard of delta facts against the first LHS statement of the rules
+    they trigger, in a worker process of `InferenceEngine.saturate`
+
+    Args:
+        shard ((listof tuple, listof (int, tupleof int))): (length, constants,
+            repeats, slots) of the compiled first LHS statement of each rule
+            (see `util.Pattern`), and index and key of each fact
+
+    Returns:
+        listof (int, int, tupleof int): fact index, rule position and values
+            bound to the slots of every match, by fact then rule
+    """
+    patterns, facts = shard
+    matches = []
+    for index, key in facts:
+        for position, (length, constants, repeats, slots) in enumerate(patterns):
+            if len(key) != length:
+                continue
+            for place, symbol in constants:
+                if key[place] != symbol:
+                    break
+            else:
+                for place, first in repeats:
+                    if key[place] != key[first]:
+                        break
+                else:
+                    matches.append((index, position, tuple([key[place] for place in slots])))
+    return matches
\ No newline at end of file
@@ -0,0 +1,107 @@
+import asyncio
+from logical_classes import *
+from function import KnowledgeBase
+
+class AsyncKnowledgeBase(object):
+    """asyncio front-end for a KnowledgeBase. Forward chaining runs in slices
+        between which the event loop gets control back, so a long cascade of
+        inferences does not block other tasks. Writes are queued one at a time;
+        queries are answered from a snapshot of the KB taken after the last
+        completed write, so they never wait for a running inference nor see
+        a half-propagated closure.
+
+    Attributes:
+        kb (KnowledgeBase): KB being wrapped
+        steps (int): number of agenda items added per slice of forward chaining
+        budget (float|None): longest time in seconds a slice may run, None for
+            no limit
+    """
+    def __init__(self, kb=None, steps=100, budget=0.01):
+        """Constructor for AsyncKnowledgeBase
+
+        Args:
+            kb (KnowledgeBase|None): KB to wrap, defaults to an empty one. It
+                should only be changed through the wrapper from then on
+            steps (int): see above
+            budget (float|None): see above
+        """
+        super(AsyncKnowledgeBase, self).__init__()
+        self.kb = kb if kb is not None else KnowledgeBase([], [])
+        self.steps = steps
+        self.budget = budget
+        self._writing = asyncio.Lock()
+        self._view = self.kb.snapshot()
+
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return 'AsyncKnowledgeBase({!r})'.format(self.kb)
+
+    async def assert_(self, fact_rule, budget=None):
+        """Assert a fact or rule, giving control back to the event loop every
+            `steps` inferences or `budget` seconds. Returns once the closure is
+            complete. If the task is cancelled, the rest of the closure is
+            completed at once before the cancellation goes on.
+
+        Args:
+            fact_rule (Fact|Rule): fact or rule to assert
+            budget (float|None): slice length for this call, defaults to the
+                budget of the wrapper
+        """
+        async with self._writing:
+            slices = self.kb._assert_steps(fact_rule, self.steps,
+                                           self.budget if budget is None else budget)
+            try:
+                for _ in slices:
+                    await asyncio.sleep(0)
+            finally:
+                slices.close()
+                self._view = self.kb.snapshot()
+
+    async def retract(self, fact_or_rule):
+        """Retract a fact or rule, see KnowledgeBase.kb_retract
+
+        Args:
+            fact_or_rule (Fact|Rule): fact or rule to retract
+        """
+        async with self._writing:
+            try:
+                self.kb.kb_retract(fact_or_rule)
+            finally:
+                self._view = self.kb.snapshot()
+
+    async def ask(self, fact, limit=None, offset=0):
+        """Ask if a fact is in the KB, see KnowledgeBase.kb_ask
+
+        Args:
+            fact (Fact): statement to be asked
+            limit (int|None): return at most this many bindings, None for all
+            offset (int): number of answers to skip first
+
+        Returns:
+            ListOfBindings|[]: bindings found, [] if there is none
+        """
+        bindings_lst = ListOfBindings()
+        async for bindings, facts in self.ask_iter(fact, limit, offset):
+            bindings_lst.add_bindings(bindings, facts)
+        return bindings_lst if bindings_lst.list_of_bindings else []
+
+    async def ask_iter(self, fact, limit=None, offset=0):
+        """Asynchronously yield the answers to a query from the current
+            snapshot, giving control back to the event loop every `steps`
+            answers
+
+        Args:
+            fact (Fact|Statement): statement to be asked
+            limit (int|None): yield at most this many answers, None for all
+            offset (int): number of answers to skip first
+
+        Yields:
+            (Bindings, listof Fact): see KnowledgeBase.kb_ask_iter
+        """
+        count = 0
+        for answer in self._view.kb_ask_iter(fact, limit, offset):
+            yield answer
+            count += 1
+            if count % self.steps == 0:
+                await asyncio.sleep(0)
@@ -0,0 +1,114 @@
+import functools, threading
+
+class ReadWriteLock(object):
+    """Lock shared by any number of readers or held by a single writer.
+        Writers take precedence: once a writer waits, new readers wait too, so
+        a steady flow of queries cannot starve updates. Both sides are
+        reentrant, and the thread holding the write lock may also read; a
+        reader asking to write raises RuntimeError instead of deadlocking.
+    """
+    def __init__(self):
+        """Constructor for ReadWriteLock
+        """
+        super(ReadWriteLock, self).__init__()
+        self._condition = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = None
+        self._depth = 0
+        self._waiting = 0
+        self._local = threading.local()
+
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return 'ReadWriteLock({} readers, writer={!r}, {} waiting)'.format(
+            self._readers, self._writer, self._waiting)
+
+    def _held(self):
+        """INTERNAL USE ONLY
+        Number of read locks held by the current thread
+        """
+        return getattr(self._local, 'count', 0)
+
+    def acquire_read(self):
+        """Acquire the lock for reading, waiting while a writer holds or waits
+            for it (unless the current thread already holds it)
+        """
+        with self._condition:
+            if self._writer == threading.get_ident():
+                self._depth += 1
+                return
+            if not self._held():
+                while self._writer is not None or self._waiting:
+                    self._condition.wait()
+                self._readers += 1
+            self._local.count = self._held() + 1
+
+    def release_read(self):
+        """Release a read acquired by `acquire_read`
+        """
+        with self._condition:
+            if self._writer == threading.get_ident():
+                self._depth -= 1
+                return
+            self._local.count = self._held() - 1
+            if not self._local.count:
+                self._readers -= 1
+                if not self._readers:
+                    self._condition.notify_all()
+
+    def acquire_write(self):
+        """Acquire the lock for writing, waiting until no other thread holds it
+
+        Raises:
+            RuntimeError: if the current thread holds the lock for reading
+        """
+        with self._condition:
+            me = threading.get_ident()
+            if self._writer == me:
+                self._depth += 1
+                return
+            if self._held():
+                raise RuntimeError("cannot write while reading")
+            self._waiting += 1
+            try:
+                while self._writer is not None or self._readers:
+                    self._condition.wait()
+            finally:
+                self._waiting -= 1
+            self._writer = me
+            self._depth = 1
+
+    def release_write(self):
+        """Release a write acquired by `acquire_write`
+        """
+        with self._condition:
+            self._depth -= 1
+            if not self._depth:
+                self._writer = None
+                self._condition.notify_all()
+
+
+def reading(method):
+    """Decorate a method so that it runs holding `self._lock` for reading
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        self._lock.acquire_read()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self._lock.release_read()
+    return wrapper
+
+def writing(method):
+    """Decorate a method so that it runs holding `self._lock` for writing
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        self._lock.acquire_write()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self._lock.release_write()
+    return wrapper
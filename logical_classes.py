@@ -1,3 +1,5 @@
+import threading
+from reprlib import recursive_repr
 from util import is_var
 
 class Fact(object):
@@ -10,11 +12,15 @@ class Fact(object):
         statement (Statement): statement of this fact, basically what the fact actually says
         asserted (bool): boolean flag indicating if fact was asserted instead of
             inferred from other rules/facts in the KB
-        supported_by (listof Fact|Rule): Facts/Rules that allow inference of
-            the statement
-        supports_facts (listof Fact): Facts that this fact supports
-        supports_rules (listof Rule): Rules that this fact supports
+        supported_by (Justifications): justifications of the statement, i.e.
+            tuples of the Facts/Rules that allow inference of it
+        supports_facts (IdentitySet of Fact): Facts that this fact supports
+        supports_rules (IdentitySet of Rule): Rules that this fact supports
     """
+    __slots__ = ('statement', 'asserted', 'supported_by', 'supports_facts',
+                 'supports_rules')
+    name = "fact"
+
     def __init__(self, statement, supported_by=[]):
         """Constructor for Fact setting up useful flags and generating appropriate statement
 
@@ -25,15 +31,11 @@ class Fact(object):
                 the statement
         """
         super(Fact, self).__init__()
-        self.name = "fact"
         self.statement = statement if isinstance(statement, Statement) else Statement(statement)
         self.asserted = not supported_by
-        #self.supported_by = supported_by
-        self.supported_by = []
-        self.supports_facts = []
-        self.supports_rules = []
-        for pair in supported_by:
-           self.supported_by.append(pair)
+        self.supported_by = Justifications(supported_by)
+        self.supports_facts = IdentitySet()
+        self.supports_rules = IdentitySet()
 
     def __repr__(self):
         """Define internal string representation
@@ -49,15 +51,15 @@ class Fact(object):
         string = self.name + ":\n"
         string += "\t" + str(self.statement) + "\n"
         string += "\t Asserted:       " + str(self.asserted) + "\n"
-        if self.supported_by != []:
+        if self.supported_by:
             name_strings = [str(x.name) for y in self.supported_by for x in y]
             supported_by_str = ", ".join(name_strings)
             string += "\t Supported by:   [" + supported_by_str + "]\n"
-        if self.supports_facts != []:
+        if self.supports_facts:
             name_strings = [str(x.name) for x in self.supports_facts]
             supports_f_str = ", ".join(name_strings)
             string += "\t Supports facts: [" + supports_f_str + "]\n"
-        if self.supports_rules != []:
+        if self.supports_rules:
             name_strings = [str(x.name) for x in self.supports_rules]
             supports_r_str = ", ".join(name_strings)
             string += "\t Supports rules: [" + supports_r_str + "]\n"
@@ -73,6 +75,11 @@ class Fact(object):
         """
         return not self == other
 
+    def __hash__(self):
+        """Define hash, consistent with == (facts with equal statements)
+        """
+        return hash(self.statement)
+
 class Rule(object):
     """Represents a rule in our knowledge base. Has a list of statements (the LHS)
         containing the statements that need to be in our KB for us to infer the
@@ -85,11 +92,15 @@ class Rule(object):
         rhs (Statement): RHS statment of this rule
         asserted (bool): boolean flag indicating if rule was asserted instead of
             inferred from other rules/facts in the KB
-        supported_by (listof Fact|Rule): Facts/Rules that allow inference of
-            the statement
-        supports_facts (listof Fact): Facts that this rule supports
-        supports_rules (listof Rule): Rules that this rule supports
+        supported_by (Justifications): justifications of the rule, i.e.
+            tuples of the Facts/Rules that allow inference of it
+        supports_facts (IdentitySet of Fact): Facts that this rule supports
+        supports_rules (IdentitySet of Rule): Rules that this rule supports
     """
+    __slots__ = ('lhs', 'rhs', 'asserted', 'supported_by', 'supports_facts',
+                 'supports_rules')
+    name = "rule"
+
     def __init__(self, rule, supported_by=[]):
         """Constructor for Rule setting up useful flags and generating appropriate LHS & RHS
 
@@ -100,15 +111,12 @@ class Rule(object):
                 the statement
         """
         super(Rule, self).__init__()
-        self.name = "rule"
         self.lhs = [statement if isinstance(statement, Statement) else Statement(statement) for statement in rule[0]]
         self.rhs = rule[1] if isinstance(rule[1], Statement) else Statement(rule[1])
         self.asserted = not supported_by
-        self.supported_by = []
-        self.supports_facts = []
-        self.supports_rules = []
-        for pair in supported_by:
-            self.supported_by.append(pair)
+        self.supported_by = Justifications(supported_by)
+        self.supports_facts = IdentitySet()
+        self.supports_rules = IdentitySet()
 
     def __repr__(self):
         """Define internal string representation
@@ -127,15 +135,15 @@ class Rule(object):
             string += "\t\t" + str(statement) + "\n"
         string += "\t Right hand:\n\t\t" + str(self.rhs) + "\n"
         string += "\t Asserted:       " + str(self.asserted) + "\n"
-        if self.supported_by != []:
+        if self.supported_by:
             name_strings = [str(x.name) for y in self.supported_by for x in y ]
             supported_by_str = ", ".join(name_strings)
             string += "\t Supported by:   [" + supported_by_str + "]\n"
-        if self.supports_facts != []:
+        if self.supports_facts:
             name_strings = [str(x.name) for x in self.supports_facts]
             supports_f_str = ", ".join(name_strings)
             string += "\t Supports facts: [" + supports_f_str + "]\n"
-        if self.supports_rules != []:
+        if self.supports_rules:
             name_strings = [str(x.name) for x in self.supports_rules]
             supports_r_str = ", ".join(name_strings)
             string += "\t Supports rules: [" + supports_r_str + "]\n"
@@ -152,16 +160,136 @@ class Rule(object):
         """
         return not self == other
 
+    def __hash__(self):
+        """Define hash, consistent with == (rules with equal LHS and RHS)
+        """
+        return hash((tuple(self.lhs), self.rhs))
+
+class IdentitySet(object):
+    """Insertion-ordered set of objects compared by identity rather than by
+        ==, e.g. the facts or rules a fact supports. Membership, addition and
+        removal are O(1), and adding an object already in the set does nothing.
+    """
+    __slots__ = ('_items',)
+
+    def __init__(self, items=()):
+        """Constructor for IdentitySet
+
+        Args:
+            items (iterable): objects the set starts with, in order
+        """
+        super(IdentitySet, self).__init__()
+        self._items = {}
+        for item in items:
+            self.add(item)
+
+    def __reduce__(self):
+        """Pickle the items, identities are only valid in the current process
+        """
+        return (type(self), (), list(self))
+
+    def __setstate__(self, items):
+        for item in items:
+            self.add(item)
+
+    @recursive_repr()
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return '{}({!r})'.format(type(self).__name__, list(self))
+
+    def __len__(self):
+        """Define behavior of len, i.e. number of objects in the set
+        """
+        return len(self._items)
+
+    def __iter__(self):
+        """Iterate over the objects in insertion order
+        """
+        return iter(self._items.values())
+
+    def __contains__(self, item):
+        """Define behavior of `in`, i.e. whether this very object is in the set
+        """
+        return self._key(item) in self._items
+
+    def _key(self, item):
+        """INTERNAL USE ONLY
+        Hashable identity of an object of the set
+        """
+        return id(item)
+
+    def add(self, item):
+        """Add an object unless it is already in the set
+
+        Args:
+            item (any): object to add
+
+        Returns:
+            bool: True if the object was added, False if already in the set
+        """
+        key = self._key(item)
+        if key in self._items:
+            return False
+        self._items[key] = item
+        return True
+
+    append = add
+
+    def discard(self, item):
+        """Remove an object if it is in the set
+
+        Args:
+            item (any): object to remove
+        """
+        self._items.pop(self._key(item), None)
+
+
+class Justifications(IdentitySet):
+    """Insertion-ordered set of the justifications of a fact or rule, i.e.
+        tuples of the facts and rules it was inferred from. Two justifications
+        are the same if they are made of the very same facts and rules, so
+        reaching a derivation again does not add a copy of it.
+    """
+    __slots__ = ()
+
+    def _key(self, justification):
+        """INTERNAL USE ONLY
+        Hashable identity of a justification
+        """
+        return tuple(id(x) for x in justification)
+
+    def add(self, justification):
+        """Add a justification unless it is already in the set
+
+        Args:
+            justification (listof Fact|Rule): facts and rules inferring the
+                fact or rule, e.g. [rule, fact]
+
+        Returns:
+            bool: True if the justification was added, False if already there
+        """
+        return super(Justifications, self).add(tuple(justification))
+
+    append = add
+
+
 class Statement(object):
     """Represents a statement in our knowledge base, e.g. (attacked Ai Nosliw),
         (diamonds Loot), (isa Sorceress Wizard), etc. These statements show up
-        in Facts or on the LHS and RHS of Rules
+        in Facts or on the LHS and RHS of Rules. Statements are immutable: their
+        key and hash are computed once, so comparing or hashing them is cheap.
 
     Attributes:
-        terms (listof Term): List of terms (Variable or Constant) in the
-            statement, e.g. 'Nosliw' or '?d'
+        terms (tupleof Term): Terms (Variable or Constant) in the statement,
+            e.g. 'Nosliw' or '?d'
         predicate (str): The predicate of the statement, e.g. isa, hero, needs
+        key (tupleof int): symbol ids of the predicate and of every term, e.g.
+            the key of (isa cube block) is (symbol_id('isa'), symbol_id('cube'),
+            symbol_id('block')); variables have negative ids
     """
+    __slots__ = ('predicate', 'key', '_hash')
+
     def __init__(self, statement_list=[]):
         """Constructor for Statements with optional list of Statements that are
             converted to appropriate terms (and one predicate)
@@ -172,18 +300,48 @@ class Statement(object):
                 the list is either instantiated Terms or strings to be passed to the
                 Term constructor
         """
-        super(Statement, self).__init__()
-        self.terms = []
-        self.predicate = ""
-
         if statement_list:
-            self.predicate = statement_list[0]
-            self.terms = [t if isinstance(t, Term) else Term(t) for t in statement_list[1:]]
+            predicate = statement_list[0]
+            # strings, e.g. from the parser, go straight to the symbol table
+            ids = [symbol_id(t) if type(t) is str else
+                   (t if isinstance(t, Term) else Term(t)).id for t in statement_list[1:]]
+        else:
+            predicate, ids = "", []
+        self.predicate = predicate
+        self.key = tuple([symbol_id(predicate)] + ids)
+        self._hash = hash(self.key)
+
+    @property
+    def terms(self):
+        """tupleof Term: the terms of the statement, built from the key"""
+        return tuple([symbol_term(i) for i in self.key[1:]])
+
+    @classmethod
+    def from_key(cls, key):
+        """Build the statement having the given key, e.g. from symbol ids
+            computed by matching
+
+        Args:
+            key (tupleof int): symbol ids of the predicate and of the terms
+
+        Returns:
+            Statement
+        """
+        statement = cls.__new__(cls)
+        statement.predicate = symbol(key[0]).element
+        statement.key = key
+        statement._hash = hash(key)
+        return statement
+
+    def __reduce__(self):
+        """Pickle by value, symbol ids are only valid in the current process
+        """
+        return (Statement, ([self.predicate] + list(self.terms),))
 
     def __repr__(self):
         """Define internal string representation
         """
-        return 'Statement({!r}, {!r})'.format(self.predicate, self.terms)
+        return 'Statement({!r}, {!r})'.format(self.predicate, list(self.terms))
 
     def __str__(self):
         """Define external representation when printed
@@ -193,38 +351,46 @@ class Statement(object):
     def __eq__(self, other):
         """Define behavior of == when applied to this object
         """
-        if self.predicate != other.predicate:
-            return False
-
-        for self_term, other_term in zip(self.terms, other.terms):
-            if self_term != other_term:
-                return False
-
-        return True
+        return self is other or (isinstance(other, Statement)
+            and self._hash == other._hash and self.key == other.key)
 
     def __ne__(self, other):
         """Define behavior of != when applied to this object
         """
         return not self == other
 
+    def __hash__(self):
+        """Define hash, precomputed from the key
+        """
+        return self._hash
+
 class Term(object):
     """Represents a term (a Variable or Constant) in our knowledge base. Can
         sorta be thought of as a super class of Variable and Constant, though
-        there is no inheritance implemented in the code.
+        there is no inheritance implemented in the code. Terms are interned:
+        there is a single Term per Variable or Constant.
 
     Attributes:
         term (Variable|Constant): The Variable or Constant that this term holds (represents)
+        id (int): symbol id of the Variable or Constant
     """
-    def __init__(self, term):
+    __slots__ = ('term', 'id')
+
+    def __new__(cls, term):
         """Constructor for Term which converts term to appropriate form
 
         Args:
             term (Variable|Constant|string): Either an instantiated Variable or
                 Constant, or a string to be passed to the appropriate constructor
         """
-        super(Term, self).__init__()
         is_var_or_const = isinstance(term, Variable) or isinstance(term, Constant)
-        self.term = term if is_var_or_const else (Variable(term) if is_var(term) else Constant(term))
+        term = term if is_var_or_const else (Variable(term) if is_var(term) else Constant(term))
+        return symbol_term(term.id)
+
+    def __reduce__(self):
+        """Pickle by value, symbol ids are only valid in the current process
+        """
+        return (Term, (self.term,))
 
     def __repr__(self):
         """Define internal string representation
@@ -249,20 +415,43 @@ class Term(object):
         """
         return not self == other
 
+    def __hash__(self):
+        """Define hash, consistent with == on Variable and Constant
+        """
+        return hash(self.term.element)
+
 class Variable(object):
-    """Represents a variable used in statements
+    """Represents a variable used in statements. Variables are interned: there
+        is a single Variable per name.
 
     Attributes:
         element (str): The name of the variable, e.g. '?x'
+        id (int): symbol id of the variable, always negative
     """
-    def __init__(self, element):
+    __slots__ = ('element', 'id')
+
+    def __new__(cls, element):
         """Constructor for Variable
 
         Args:
             element (str): The name of the variable, e.g. '?x'
         """
-        super(Variable, self).__init__()
-        self.element = element
+        variable = _variables.get(element)
+        if variable is None:
+            with _intern_lock:
+                variable = _variables.get(element)
+                if variable is None:
+                    variable = object.__new__(cls)
+                    variable.element = element
+                    variable.id = -1 - len(_variable_symbols)
+                    _variable_symbols.append(variable)
+                    _variables[element] = variable
+        return variable
+
+    def __reduce__(self):
+        """Pickle by value, symbol ids are only valid in the current process
+        """
+        return (Variable, (self.element,))
 
     def __repr__(self):
         """Define internal string representation
@@ -278,29 +467,52 @@ class Variable(object):
         """Define behavior of == when applied to this object
         """
         return (self is other
-            or isinstance(other, Term) and self.term.element == other.term.element
+            or isinstance(other, Term) and self.element == other.term.element
             or ((isinstance(other, Variable) or isinstance(other, Constant))
-                and self.term.element == other.element))
+                and self.element == other.element))
 
     def __ne__(self, other):
         """Define behavior of != when applied to this object
         """
         return not self == other
 
+    def __hash__(self):
+        """Define hash, consistent with == on Term and Constant
+        """
+        return hash(self.element)
+
 class Constant(object):
-    """Represents a constant used in statements
+    """Represents a constant used in statements. Constants are interned: there
+        is a single Constant per value.
 
     Attributes:
         element (str): The value of the constant, e.g. 'Nosliw'
+        id (int): symbol id of the constant, never negative
     """
-    def __init__(self, element):
+    __slots__ = ('element', 'id')
+
+    def __new__(cls, element):
         """Constructor for Constant
 
         Args:
             element (str): The value of the constant, e.g. 'Nosliw'
         """
-        super(Constant, self).__init__()
-        self.element = element
+        constant = _constants.get(element)
+        if constant is None:
+            with _intern_lock:
+                constant = _constants.get(element)
+                if constant is None:
+                    constant = object.__new__(cls)
+                    constant.element = element
+                    constant.id = len(_symbols)
+                    _symbols.append(constant)
+                    _constants[element] = constant
+        return constant
+
+    def __reduce__(self):
+        """Pickle by value, symbol ids are only valid in the current process
+        """
+        return (Constant, (self.element,))
 
     def __repr__(self):
         """Define internal string representation
@@ -316,15 +528,75 @@ class Constant(object):
         """Define behavior of == when applied to this object
         """
         return (self is other
-            or isinstance(other, Term) and self.term.element == other.term.element
+            or isinstance(other, Term) and self.element == other.term.element
             or ((isinstance(other, Variable) or isinstance(other, Constant))
-                and self.term.element == other.element))
+                and self.element == other.element))
 
     def __ne__(self, other):
         """Define behavior of != when applied to this object
         """
         return not self == other
 
+    def __hash__(self):
+        """Define hash, consistent with == on Term and Variable
+        """
+        return hash(self.element)
+
+# Symbol tables: every Constant (and predicate) and Variable gets an integer id,
+# constants counting up from 0 and variables down from -1. They are only
+# changed holding _intern_lock, lookups of known symbols do not take it
+_intern_lock = threading.Lock()
+_symbols = []
+_constants = {}
+_variable_symbols = []
+_variables = {}
+_terms = {}
+
+def symbol_id(element):
+    """Get the symbol id of a string, interning it if needed
+
+    Args:
+        element (str): name of a variable (e.g. '?x') or value of a constant
+
+    Returns:
+        int: negative for variables, positive or zero for constants
+    """
+    symbol = _variables.get(element) or _constants.get(element)
+    if symbol is None:
+        symbol = Variable(element) if is_var(element) else Constant(element)
+    return symbol.id
+
+def symbol(symbol_id):
+    """Get the Variable or Constant having the given symbol id
+
+    Args:
+        symbol_id (int): id of the symbol
+
+    Returns:
+        Variable|Constant
+    """
+    return _variable_symbols[-1 - symbol_id] if symbol_id < 0 else _symbols[symbol_id]
+
+def symbol_term(symbol_id):
+    """Get the interned Term holding the symbol with the given id
+
+    Args:
+        symbol_id (int): id of the symbol
+
+    Returns:
+        Term
+    """
+    term = _terms.get(symbol_id)
+    if term is None:
+        with _intern_lock:
+            term = _terms.get(symbol_id)
+            if term is None:
+                term = object.__new__(Term)
+                term.term = symbol(symbol_id)
+                term.id = symbol_id
+                _terms[symbol_id] = term
+    return term
+
 class Binding(object):
     """Represents a binding of a constant to a variable, e.g. 'Nosliw' might be
         bound to'?d'
@@ -355,19 +627,52 @@ class Binding(object):
         return self.variable.element.upper() + " : " + self.constant.element
 
 class Bindings(object):
-    """Represents Binding(s) used while matching two statements
+    """Represents Binding(s) used while matching two statements. Each bound
+        variable has a slot and the bindings are an array of the symbol ids
+        bound to the slots; `bindings` and `bindings_dict` are built from it on
+        demand. Bindings made by a compiled Pattern share the pattern's
+        variables and slot map until a binding is added to them.
 
     Attributes:
-        bindings (listof Bindings): bindings involved in match
-        bindings_dict (dictof Bindings): bindings involved in match where key is
+        bindings (listof Binding): bindings involved in match
+        bindings_dict (dictof str): bindings involved in match where key is
             bound variable and value is bound value,
             e.g. some_bindings.bindings_dict['?d'] => 'Nosliw'
+        variables (listof Variable): the variable of each slot
+        values (listof int): symbol id bound to each slot
     """
-    def __init__(self):
-        """Constructor for Bindings creating initially empty instance
-        """
-        self.bindings = []
-        self.bindings_dict = {}
+    __slots__ = ('variables', 'values', '_slots', '_shared')
+
+    def __init__(self, variables=None, values=None, slots=None):
+        """Constructor for Bindings, creating an initially empty instance unless
+            slots are given
+
+        Args:
+            variables (tupleof Variable|None): the variable of each slot, shared
+                with the caller until a binding is added
+            values (listof int|None): symbol id bound to each slot, owned by the
+                new instance
+            slots (dictof int|None): slot of each variable keyed by its symbol id,
+                shared with the caller until a binding is added
+        """
+        if variables is None:
+            self.variables, self.values, self._slots = [], [], {}
+            self._shared = False
+        else:
+            self.variables, self.values, self._slots = variables, values, slots
+            self._shared = True
+
+    @property
+    def bindings(self):
+        """listof Binding: one Binding per slot, in slot order"""
+        return [Binding(variable, symbol(value))
+                for variable, value in zip(self.variables, self.values)]
+
+    @property
+    def bindings_dict(self):
+        """dictof str: bound value of each bound variable"""
+        return dict((variable.element, symbol(value).element)
+                    for variable, value in zip(self.variables, self.values))
 
     def __repr__(self):
         """Define internal string representation
@@ -377,7 +682,7 @@ class Bindings(object):
     def __str__(self):
         """Define external representation when printed
         """
-        if self.bindings == []:
+        if not self.values:
             return "No bindings"
         return ", ".join((str(binding) for binding in self.bindings))
 
@@ -386,9 +691,18 @@ class Bindings(object):
             random_bindings.bindings_dict[key] when the dictionary is not empty
             and the key exists, otherwise None
         """
-        return (self.bindings_dict[key] 
-                if (self.bindings_dict and key in self.bindings_dict)
-                else None)
+        variable = _variables.get(key)
+        slot = self._slots.get(variable.id) if variable is not None else None
+        return symbol(self.values[slot]).element if slot is not None else None
+
+    def _own(self):
+        """INTERNAL USE ONLY
+        Copy the variables and slot map shared with a Pattern or another
+        Bindings before modifying them
+        """
+        self.variables = list(self.variables)
+        self._slots = dict(self._slots)
+        self._shared = False
 
     def add_binding(self, variable, value):
         """Add a binding from a variable to a value
@@ -397,8 +711,27 @@ class Bindings(object):
             variable (Variable): the variable to bind to
             value (Constant): the value to bind to the variable
         """
-        self.bindings_dict[variable.element] = value.element
-        self.bindings.append(Binding(variable, value))
+        if self._shared:
+            self._own()
+        slot = self._slots.get(variable.id)
+        if slot is None:
+            self._slots[variable.id] = len(self.values)
+            self.variables.append(variable)
+            self.values.append(value.id)
+        else:
+            self.values[slot] = value.id
+
+    def bound_id(self, symbol_id):
+        """Get the symbol id bound to a variable
+
+        Args:
+            symbol_id (int): symbol id of the variable
+
+        Returns:
+            int|None: bound symbol id, None if the variable is not bound
+        """
+        slot = self._slots.get(symbol_id)
+        return self.values[slot] if slot is not None else None
 
     def bound_to(self, variable):
         """Check if variable is bound. If so return value bound to it, else False.
@@ -409,12 +742,8 @@ class Bindings(object):
         Returns:
             Variable|Constant|False: returns bound term if variable is bound else False
         """
-        if variable.element in self.bindings_dict.keys():
-            value = self.bindings_dict[variable.element]
-            if value:
-                return Variable(value) if is_var(value) else Constant(value)
-
-        return False
+        slot = self._slots.get(variable.id)
+        return symbol(self.values[slot]) if slot is not None else False
 
     def test_and_bind(self, variable_term, value_term):
         """Check if variable_term already bound. If so return whether or not passed
@@ -429,13 +758,46 @@ class Bindings(object):
             bool: if variable bound returns whether or not bound value matches value_term,
                 else True
         """
-        bound = self.bound_to(variable_term.term)
-        if bound:
-            return value_term.term == bound
-            
+        slot = self._slots.get(variable_term.id)
+        if slot is not None:
+            return self.values[slot] == value_term.id
+
         self.add_binding(variable_term.term, value_term.term)
         return True
 
+    def copy(self):
+        """Copy these bindings. Only the values are copied, the variables and
+            slot map are shared until either copy adds a binding.
+
+        Returns:
+            Bindings
+        """
+        self._shared = True
+        return Bindings(self.variables, list(self.values), self._slots)
+
+    def mark(self):
+        """Get a mark to backtrack to with `undo`
+
+        Returns:
+            int: number of bound slots
+        """
+        return len(self.values)
+
+    def undo(self, mark):
+        """Backtrack, dropping the bindings added since `mark` was called
+
+        Args:
+            mark (int): value returned by `mark`
+        """
+        if mark >= len(self.values):
+            return
+        if self._shared:
+            self._own()
+        for variable in self.variables[mark:]:
+            del self._slots[variable.id]
+        del self.variables[mark:]
+        del self.values[mark:]
+
 
 class ListOfBindings(object):
     """Container for multiple Bindings
@@ -1,7 +1,15 @@
-import unittest
+import asyncio, os, tempfile, threading, time, unittest
 import read, copy
+from util import *
 from logical_classes import *
-from function import KnowledgeBase
+from function import KnowledgeBase, InferenceEngine
+from store import FactStore
+from rete import ReteEngine
+from agenda import Agenda
+from wal import WriteAheadLog, encode, decode, ASSERT
+from locks import ReadWriteLock
+from async_kb import AsyncKnowledgeBase
+from sharded import ShardedKnowledgeBase
 
 class KBTest(unittest.TestCase):
 
@@ -71,6 +79,890 @@ class KBTest(unittest.TestCase):
         self.assertEqual(str(answer[0]), "?X : bing")
 
 
+class FactStoreTest(unittest.TestCase):
+
+    def test_dedup_and_order(self):
+        store = FactStore()
+        self.assertTrue(store.add(read.parse_input("fact: (isa cube block)")))
+        self.assertTrue(store.add(read.parse_input("fact: (inst cube1 cube)")))
+        self.assertFalse(store.add(read.parse_input("fact: (isa cube block)")))
+        self.assertEqual(len(store), 2)
+        fact = store.get(read.parse_input("fact: (inst cube1 cube)"))
+        self.assertEqual(str(fact.statement), "(inst cube1 cube)")
+
+    def test_remove_keeps_insertion_order(self):
+        store = FactStore()
+        facts = [read.parse_input("fact: (size box%d big)" % i) for i in range(200)]
+        for fact in facts:
+            store.add(fact)
+        for fact in facts[::2]:
+            store.remove(fact)
+        self.assertEqual(list(store), facts[1::2])
+        self.assertEqual(list(store.with_predicate('size')), facts[1::2])
+        self.assertIsNone(store.get(facts[0]))
+
+
+class ArgumentIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.KB = KnowledgeBase([], [])
+        for item in read.read_tokenize('statements_kb.txt'):
+            self.KB.kb_assert(item)
+
+    def test_candidates_use_bound_positions(self):
+        ask = read.parse_input("fact: (color ?x red)")
+        candidates = list(self.KB._facts.candidates(ask.statement))
+        self.assertEqual([str(f.statement) for f in candidates],
+                         ["(color bigbox red)", "(color pyramid3 red)",
+                          "(color pyramid4 red)"])
+        ground = read.parse_input("fact: (inst cube1 block)")
+        self.assertEqual(len(list(self.KB._facts.candidates(ground.statement))), 1)
+
+    def test_ask_with_constants(self):
+        answer = self.KB.kb_ask(read.parse_input("fact: (inst ?x pyramid)"))
+        self.assertEqual([str(answer[i]) for i in range(len(answer))],
+                         ["?X : pyramid1", "?X : pyramid2", "?X : pyramid3",
+                          "?X : pyramid4"])
+        self.assertFalse(self.KB.kb_ask(read.parse_input("fact: (inst nothing ?y)")))
+
+    def test_facts_with_variables(self):
+        kb = KnowledgeBase([], [])
+        kb.kb_assert(read.parse_input("fact: (likes ?x pizza)"))
+        kb.kb_assert(read.parse_input("fact: (likes ann soup)"))
+        for source in (kb, kb.snapshot()):
+            answer = source.kb_ask(read.parse_input("fact: (likes bob pizza)"))
+            self.assertEqual(str(answer[0]), "?X : bob")
+            answer = source.kb_ask(read.parse_input("fact: (likes bob ?y)"))
+            self.assertEqual(str(answer[0]), "?X : bob, ?Y : pizza")
+            self.assertEqual(len(answer), 1)
+        conjunction = kb.kb_ask_conjunction([read.parse_input("fact: (likes bob ?y)").statement])
+        self.assertEqual(str(conjunction[0]), "?Y : pizza")
+        kb.kb_assert(read.parse_input("rule: ((likes bob ?y)) -> (eats bob ?y)"))
+        self.assertTrue(kb.kb_ask(read.parse_input("fact: (eats bob pizza)")))
+
+
+class ReteTest(KBTest):
+
+    def setUp(self):
+        # Assert starter facts into a KB running the Rete engine
+        file = 'statements_kb4.txt'
+        self.data = read.read_tokenize(file)
+        self.KB = KnowledgeBase([], [], engine=ReteEngine())
+        for item in self.data:
+            if isinstance(item, Fact) or isinstance(item, Rule):
+                self.KB.kb_assert(item)
+
+    def test_no_curried_rules(self):
+        # partial matches stay in the network, only asserted rules are stored
+        self.assertEqual(len(self.KB.rules), 3)
+        fact = self.KB._get_fact(read.parse_input("fact: (grandmotherof ada chen)"))
+        self.assertEqual(len(list(fact.supported_by)[0]), 3)
+
+    def test_shared_join_nodes(self):
+        kb = KnowledgeBase([], [], engine=ReteEngine())
+        for item in read.read_tokenize('statements_kb.txt'):
+            kb.kb_assert(item)
+        answer = kb.kb_ask(read.parse_input("fact: (inst ?x block)"))
+        self.assertEqual(len(answer), 9)
+        # both `happy` rules share the same two join nodes
+        self.assertEqual(len(kb.ie._nodes), 7)
+
+
+class AgendaTest(unittest.TestCase):
+
+    def chain(self, kb, depth):
+        # (p0 ?x) -> (p1 ?x), (p1 ?x) -> (p2 ?x), ...
+        for i in range(depth):
+            kb.kb_assert(Rule([[['p%d' % i, '?x']], ['p%d' % (i + 1), '?x']]))
+        kb.kb_assert(Fact(['p0', 'a']))
+
+    def test_deep_chain_no_recursion_error(self):
+        kb = KnowledgeBase([], [])
+        self.chain(kb, 1000)
+        answer = kb.kb_ask(read.parse_input("fact: (p1000 ?x)"))
+        self.assertEqual(str(answer[0]), "?X : a")
+
+    def test_strategies_reach_same_closure(self):
+        closures = []
+        for agenda in (Agenda('lifo'), Agenda('fifo'),
+                       Agenda('priority', {'inst': 1, 'flat': 0})):
+            kb = KnowledgeBase([], [], agenda=agenda)
+            for item in read.read_tokenize('statements_kb.txt'):
+                kb.kb_assert(item)
+            self.assertEqual(len(agenda), 0)
+            closures.append(sorted(str(f.statement) for f in kb.facts))
+        self.assertEqual(closures[0], closures[1])
+        self.assertEqual(closures[0], closures[2])
+
+    def test_priority_order(self):
+        agenda = Agenda('priority', {'b': 0, 'a': 1})
+        for statement in (['a', 'x'], ['b', 'x'], ['a', 'y'], ['b', 'y']):
+            agenda.push(Fact(statement))
+        popped = [str(agenda.pop().statement) for _ in range(4)]
+        self.assertEqual(popped, ["(b x)", "(b y)", "(a x)", "(a y)"])
+
+
+class TruthMaintenanceTest(unittest.TestCase):
+
+    def test_deep_chain_retract(self):
+        kb = KnowledgeBase([], [])
+        AgendaTest().chain(kb, 1000)
+        kb.kb_retract(Fact(['p0', 'a']))
+        self.assertEqual(kb.facts, [])
+        self.assertEqual(len(kb.rules), 1000)
+        for rule in kb.rules:
+            self.assertEqual(len(rule.supports_facts), 0)
+
+    def test_alternative_support_survives(self):
+        for engine in (None, ReteEngine()):
+            kb = KnowledgeBase([], [], engine=engine)
+            kb.kb_assert(read.parse_input("rule: ((a ?x)) -> (c ?x)"))
+            kb.kb_assert(read.parse_input("rule: ((b ?x)) -> (c ?x)"))
+            kb.kb_assert(read.parse_input("fact: (a k)"))
+            kb.kb_assert(read.parse_input("fact: (b k)"))
+            kb.kb_retract(read.parse_input("fact: (a k)"))
+            self.assertTrue(kb.kb_ask(read.parse_input("fact: (c k)")))
+            kb.kb_retract(read.parse_input("fact: (b k)"))
+            self.assertFalse(kb.kb_ask(read.parse_input("fact: (c k)")))
+
+    def test_asserted_and_supported(self):
+        kb = KnowledgeBase([], [])
+        kb.kb_assert(read.parse_input("rule: ((a ?x)) -> (c ?x)"))
+        kb.kb_assert(read.parse_input("fact: (a k)"))
+        kb.kb_assert(read.parse_input("fact: (c k)"))
+        # still supported by (a k): only stops being asserted
+        kb.kb_retract(read.parse_input("fact: (c k)"))
+        fact = kb._get_fact(read.parse_input("fact: (c k)"))
+        self.assertFalse(fact.asserted)
+        kb.kb_retract(read.parse_input("fact: (a k)"))
+        self.assertEqual(kb.facts, [])
+
+    def test_asserted_fact_loses_support(self):
+        kb = KnowledgeBase([], [])
+        kb.kb_assert(read.parse_input("rule: ((a ?x)) -> (c ?x)"))
+        kb.kb_assert(read.parse_input("fact: (c k)"))
+        kb.kb_assert(read.parse_input("fact: (a k)"))
+        kb.kb_retract(read.parse_input("fact: (a k)"))
+        self.assertTrue(kb.kb_ask(read.parse_input("fact: (c k)")))
+
+
+    def test_retract_many(self):
+        def closure(kb):
+            return sorted(str(f.statement) for f in kb.facts)
+        retracted = [read.parse_input("fact: (motherof ada bing)"),
+                     read.parse_input("fact: (motherof bing chen)"),
+                     read.parse_input("fact: (sisters ada eva)")]
+        for engine in (None, ReteEngine()):
+            one_by_one = KnowledgeBase([], [], engine=engine)
+            one_by_one.bulk_load(read.read_tokenize('statements_kb4.txt'))
+            for fact in retracted:
+                one_by_one.kb_retract(fact)
+            at_once = KnowledgeBase([], [], engine=engine and ReteEngine())
+            at_once.bulk_load(read.read_tokenize('statements_kb4.txt'))
+            at_once.kb_retract_many(retracted)
+            self.assertEqual(closure(at_once), closure(one_by_one))
+            self.assertFalse(at_once.kb_ask(read.parse_input("fact: (auntof ?x ?y)")))
+            self.assertEqual(sorted(map(str, at_once.rules)),
+                             sorted(map(str, one_by_one.rules)))
+
+
+class RuleRetractionTest(unittest.TestCase):
+
+    def test_engines_agree(self):
+        closures = []
+        for engine in (InferenceEngine(), InferenceEngine(join_memory=True), ReteEngine()):
+            kb = KnowledgeBase([], [], engine=engine)
+            kb.kb_assert(read.parse_input("rule: ((a ?x) (b ?x)) -> (c ?x)"))
+            kb.kb_assert(read.parse_input("fact: (a k)"))
+            kb.kb_assert(read.parse_input("fact: (b j)"))
+            kb.kb_assert(read.parse_input("fact: (a j)"))
+            kb.kb_retract(read.parse_input("rule: ((a ?x) (b ?x)) -> (c ?x)"))
+            kb.kb_assert(read.parse_input("fact: (b k)"))
+            self.assertFalse(kb.kb_ask(read.parse_input("fact: (c k)")))
+            self.assertEqual(kb.rules, [])
+            if engine.__class__ is InferenceEngine:
+                self.assertEqual(engine.partial_rules(), [])
+            closures.append(sorted(str(f.statement) for f in kb.facts))
+        self.assertEqual(closures[0], closures[1])
+        self.assertEqual(closures[0], closures[2])
+        # what the rule inferred before it was retracted is kept
+        self.assertIn("(c j)", closures[0])
+
+
+class SupportSetTest(unittest.TestCase):
+
+    def test_identity_and_dedup(self):
+        a, b = Fact(['a', 'k']), Fact(['a', 'k'])
+        supports = IdentitySet([a, b, a])
+        self.assertEqual(len(supports), 2)
+        supports.discard(Fact(['a', 'k']))
+        self.assertEqual(len(supports), 2)
+        supports.discard(a)
+        self.assertEqual(list(supports), [b])
+        justifications = Justifications([[a, b], (a, b), [b, a]])
+        self.assertEqual(list(justifications), [(a, b), (b, a)])
+
+    def test_rederivation_does_not_grow(self):
+        kb = KnowledgeBase([], [])
+        kb.kb_assert(read.parse_input("rule: ((a ?x)) -> (c ?x)"))
+        kb.kb_assert(read.parse_input("fact: (a k)"))
+        kb.saturate()
+        kb.saturate()
+        fact = kb._get_fact(read.parse_input("fact: (c k)"))
+        self.assertEqual(len(fact.supported_by), 1)
+        self.assertEqual(len(kb.rules[0].supports_facts), 1)
+        self.assertIn("Fact('fact'", repr(fact))
+
+
+class CompiledRuleTest(unittest.TestCase):
+
+    def slots(self, templates):
+        return [[slot for slot, symbol in template] for template in templates]
+
+    def test_slots(self):
+        rule = read.parse_input("rule: ((parentof ?x ?y) (parentof ?y ?z) (male ?z)) -> (grandfatherof ?z ?x)")
+        compiled = compile_rule(rule)
+        self.assertEqual([str(symbol_term(v)) for v in compiled.variables], ['?x', '?y', '?z'])
+        self.assertEqual(self.slots(compiled.premises), [[None, 0, 1], [None, 1, 2], [None, 2]])
+        self.assertEqual(self.slots([compiled.rhs]), [[None, 2, 0]])
+        self.assertIs(compile_rule(read.parse_input(
+            "rule: ((parentof ?x ?y) (parentof ?y ?z) (male ?z)) -> (grandfatherof ?z ?x)")), compiled)
+
+    def test_curry_specializes(self):
+        rule = read.parse_input("rule: ((parentof ?x ?y) (parentof ?y ?z) (male ?z)) -> (grandfatherof ?z ?x)")
+        compiled = compile_rule(rule)
+        values = compiled.first.match(read.parse_input("fact: (parentof ada bing)").statement.key)
+        lhs, rhs = compiled.curry(values)
+        self.assertEqual([str(s) for s in lhs], ["(parentof bing ?z)", "(male ?z)"])
+        self.assertEqual(str(rhs), "(grandfatherof ?z ada)")
+        curried = compile_rule(Rule([lhs, rhs]))
+        self.assertEqual(curried.premises, compiled.specialize(values).premises)
+        self.assertEqual(curried.rhs, compiled.specialize(values).rhs)
+        self.assertEqual(self.slots(curried.premises), [[None, None, 0], [None, 0]])
+
+
+class JoinMemoryTest(KBTest):
+
+    def setUp(self):
+        # Assert starter facts, keeping curried rules in the engine
+        file = 'statements_kb4.txt'
+        self.data = read.read_tokenize(file)
+        self.KB = KnowledgeBase([], [], engine=InferenceEngine(join_memory=True))
+        for item in self.data:
+            if isinstance(item, Fact) or isinstance(item, Rule):
+                self.KB.kb_assert(item)
+
+    def test_only_asserted_rules(self):
+        self.assertEqual(len(self.KB.rules), 3)
+        self.assertTrue(all(rule.asserted for rule in self.KB.rules))
+        self.assertTrue(self.KB.ie.partial_rules())
+
+    def test_same_closure_as_curried_rules(self):
+        def closure(kb):
+            return sorted(str(f.statement) for f in kb.facts)
+        for load in ('kb_assert', 'bulk_load'):
+            kb = KnowledgeBase([], [])
+            memory = KnowledgeBase([], [], engine=InferenceEngine(join_memory=True))
+            for k in (kb, memory):
+                if load == 'bulk_load':
+                    k.bulk_load(read.read_tokenize('statements_kb.txt'))
+                else:
+                    for item in read.read_tokenize('statements_kb.txt'):
+                        k.kb_assert(item)
+            self.assertEqual(closure(memory), closure(kb))
+            self.assertEqual(len(memory.ie.partial_rules()) + len(memory.rules), len(kb.rules))
+
+    def test_retract_drops_partial_rules(self):
+        fact = self.KB._get_fact(read.parse_input("fact: (parentof ada bing)"))
+        partials = list(fact.supports_rules)
+        self.assertTrue(partials)
+        self.KB.kb_retract(read.parse_input("fact: (motherof ada bing)"))
+        remaining = self.KB.ie.partial_rules()
+        for rule in partials:
+            self.assertFalse(any(rule is other for other in remaining))
+        self.assertFalse(self.KB.kb_ask(read.parse_input("fact: (grandmotherof ada chen)")))
+
+
+class TriggerIndexTest(unittest.TestCase):
+
+    class CountingEngine(InferenceEngine):
+        def __init__(self):
+            super(TriggerIndexTest.CountingEngine, self).__init__()
+            self.tried = []
+
+        def fc_infer(self, fact, rule, kb):
+            self.tried.append((str(fact.statement), str(rule.lhs[0])))
+            super(TriggerIndexTest.CountingEngine, self).fc_infer(fact, rule, kb)
+
+    def test_only_relevant_rules_tried(self):
+        engine = self.CountingEngine()
+        kb = KnowledgeBase([], [], engine=engine)
+        kb.kb_assert(read.parse_input("rule: ((size ?x big)) -> (large ?x)"))
+        kb.kb_assert(read.parse_input("rule: ((size ?x)) -> (sized ?x)"))
+        kb.kb_assert(read.parse_input("rule: ((color ?x red)) -> (red ?x)"))
+        engine.tried = []
+        kb.kb_assert(read.parse_input("fact: (size box big)"))
+        self.assertEqual(engine.tried, [("(size box big)", "(size ?x big)")])
+
+    def test_retracted_rule_not_triggered(self):
+        engine = self.CountingEngine()
+        kb = KnowledgeBase([], [], engine=engine)
+        kb.kb_assert(read.parse_input("rule: ((size ?x big)) -> (large ?x)"))
+        kb.kb_retract(read.parse_input("rule: ((size ?x big)) -> (large ?x)"))
+        kb.kb_assert(read.parse_input("fact: (size box big)"))
+        self.assertEqual(engine.tried, [])
+        self.assertEqual(kb.rules, [])
+
+
+class ParseTest(unittest.TestCase):
+
+    def test_both_rule_forms_and_comments(self):
+        items = list(read.parse_lines([
+            "# a comment\n",
+            "fact: (isa cube block)  # trailing comment\n",
+            "rule: ((inst ?x ?y)\n",
+            "       (isa ?y ?z)) -> (inst ?x ?z)\n",
+            "rule: (inst ?x cube) -> (flat ?x)\n",
+        ]))
+        self.assertEqual(str(items[0].statement), "(isa cube block)")
+        self.assertEqual([str(s) for s in items[1].lhs], ["(inst ?x ?y)", "(isa ?y ?z)"])
+        self.assertEqual(str(items[1].rhs), "(inst ?x ?z)")
+        self.assertEqual([str(s) for s in items[2].lhs], ["(inst ?x cube)"])
+        self.assertEqual(str(items[2].rhs), "(flat ?x)")
+
+    def test_same_as_files(self):
+        for file in ('statements_kb.txt', 'statements_kb2.txt', 'statements_kb4.txt'):
+            with open(file) as lines:
+                self.assertEqual(list(read.parse_lines(lines)), read.read_tokenize(file))
+
+    def test_error_position(self):
+        with self.assertRaises(read.ParseError) as error:
+            list(read.parse_lines(["fact: (isa cube block)\n", "rule: ((inst ?x ?y)) (flat ?x)\n"]))
+        self.assertEqual((error.exception.line, error.exception.column), (2, 22))
+        with self.assertRaises(read.ParseError) as error:
+            read.parse_input("fact: (isa cube")
+        self.assertEqual((error.exception.line, error.exception.column), (1, 16))
+        with self.assertRaises(read.ParseError):
+            read.parse_input("fcat: (isa cube block)")
+
+    def test_streams(self):
+        def lines():
+            yield "fact: (isa cube block)\n"
+            raise AssertionError("read too far")
+        self.assertEqual(str(next(read.parse_lines(lines())).statement), "(isa cube block)")
+
+
+class ParallelReadTest(unittest.TestCase):
+
+    def setUp(self):
+        handle, self.file = tempfile.mkstemp(suffix='.txt')
+        with os.fdopen(handle, 'w') as f:
+            for i in range(300):
+                f.write("fact: (size box%d big)\n" % i)
+                if i % 7 == 0:
+                    f.write("rule: ((size ?x big)\n    (on ?x box%d)) -> (covered box%d)\n\n" % (i, i))
+
+    def tearDown(self):
+        os.remove(self.file)
+
+    def test_same_as_serial(self):
+        serial = read.read_tokenize(self.file)
+        parallel = read.read_parallel(self.file, processes=2, chunk_size=512)
+        self.assertEqual(parallel, serial)
+        self.assertEqual([str(x) for x in parallel], [str(x) for x in serial])
+
+    def test_error_line(self):
+        with open(self.file, 'a') as f:
+            f.write("fact: (size box big\n")
+        lines = len(open(self.file).readlines())
+        with self.assertRaises(read.ParseError) as error:
+            read.read_parallel(self.file, processes=2, chunk_size=512)
+        self.assertEqual(error.exception.line, lines)
+
+
+class SnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        handle, self.file = tempfile.mkstemp(suffix='.kb')
+        os.close(handle)
+
+    def tearDown(self):
+        os.remove(self.file)
+
+    def dump(self, kb):
+        def supports(item):
+            return sorted(' '.join(str(x.statement if isinstance(x, Fact) else x.rhs)
+                                   for x in justification)
+                          for justification in item.supported_by)
+        return ([(str(f.statement), f.asserted, supports(f)) for f in kb.facts],
+                [(str(r.lhs), str(r.rhs), r.asserted, supports(r)) for r in kb.rules])
+
+    def test_round_trip(self):
+        for engine in (InferenceEngine, lambda: InferenceEngine(join_memory=True), ReteEngine):
+            kb = KnowledgeBase([], [], engine=engine())
+            kb.bulk_load(read.read_tokenize('statements_kb.txt'))
+            kb.save(self.file)
+            loaded = KnowledgeBase.load(self.file, engine=engine())
+            self.assertEqual(self.dump(loaded), self.dump(kb))
+            if kb.ie.__class__ is InferenceEngine:
+                self.assertEqual(len(loaded.ie.partial_rules()), len(kb.ie.partial_rules()))
+            # both keep chaining and retracting the same way
+            for k in (kb, loaded):
+                k.kb_assert(read.parse_input("fact: (inst block9 cube)"))
+                k.kb_retract(read.parse_input("fact: (isa cube block)"))
+            self.assertEqual(self.dump(loaded), self.dump(kb))
+
+    def test_not_a_snapshot(self):
+        with open(self.file, 'w') as f:
+            f.write("fact: (isa cube block)\n")
+        with self.assertRaises(ValueError):
+            KnowledgeBase.load(self.file)
+
+
+class WriteAheadLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.snapshot = os.path.join(self.dir, 'kb.snap')
+        self.log = os.path.join(self.dir, 'kb.log')
+
+    def tearDown(self):
+        for name in os.listdir(self.dir):
+            os.remove(os.path.join(self.dir, name))
+        os.rmdir(self.dir)
+
+    def dump(self, kb):
+        return (sorted((str(f.statement), f.asserted) for f in kb.facts),
+                sorted((str(r.lhs), str(r.rhs)) for r in kb.rules))
+
+    def test_recover(self):
+        items = read.read_tokenize('statements_kb.txt')
+        kb = KnowledgeBase([], [], log=WriteAheadLog(self.log))
+        kb.bulk_load(items[:10])
+        kb.checkpoint(self.snapshot)
+        for item in items[10:]:
+            kb.kb_assert(item)
+        kb.kb_retract(read.parse_input("fact: (isa cube block)"))
+        kb.kb_assert(read.parse_input("fact: (inst block9 cube)"))
+        kb.log.close()
+        recovered = KnowledgeBase.recover(self.snapshot, self.log)
+        self.assertEqual(self.dump(recovered), self.dump(kb))
+        recovered.log.close()
+
+    def test_group_commit_without_later_appends(self):
+        log = WriteAheadLog(self.log, interval=0.01)
+        kb = KnowledgeBase([], [], log=log)
+        kb.kb_assert(read.parse_input("fact: (isa cube block)"))
+        # handed to the OS at once, fsynced by the background thread
+        with open(self.log, 'rb') as f:
+            self.assertTrue(f.read())
+        for _ in range(100):
+            if not log._pending:
+                break
+            time.sleep(0.01)
+        self.assertEqual(log._pending, 0)
+        log.close()
+
+    def test_long_rule(self):
+        lhs = [['p%d' % i, '?x'] for i in range(300)]
+        rule = Rule([lhs, ['q', '?x']])
+        self.assertEqual(str(decode(encode(ASSERT, rule))[1]), str(rule))
+
+    def test_torn_tail(self):
+        kb = KnowledgeBase([], [], log=WriteAheadLog(self.log))
+        kb.kb_assert(read.parse_input("fact: (isa cube block)"))
+        kb.kb_assert(read.parse_input("rule: ((isa ?x block)) -> (solid ?x)"))
+        kb.log.close()
+        with open(self.log, 'ab') as f:
+            f.write(b'\x20\x00\x00\x00garbage')
+        recovered = KnowledgeBase.recover(self.snapshot, self.log)
+        self.assertEqual(self.dump(recovered), self.dump(kb))
+        self.assertEqual(len(recovered.log.records()), 2)
+        recovered.log.close()
+
+
+class ConcurrencyTest(unittest.TestCase):
+
+    def test_readers_see_whole_closures(self):
+        kb = KnowledgeBase([], [])
+        kb.kb_assert(read.parse_input("rule: ((a ?x)) -> (b ?x)"))
+        kb.kb_assert(read.parse_input("rule: ((b ?x)) -> (c ?x)"))
+        def write():
+            for i in range(300):
+                kb.kb_assert(Fact(['a', 'n%d' % i]))
+        writer = threading.Thread(target=write)
+        writer.start()
+        while writer.is_alive():
+            statements = set(str(f.statement) for f in kb.facts)
+            for statement in statements:
+                if statement.startswith('(a '):
+                    self.assertIn('(c ' + statement[3:], statements)
+        writer.join()
+        self.assertEqual(len(kb.kb_ask(read.parse_input("fact: (c ?x)"))), 300)
+
+    def test_add_waits_for_readers(self):
+        kb = KnowledgeBase([], [])
+        kb._lock.acquire_read()
+        writer = threading.Thread(target=kb.kb_add, args=(read.parse_input("fact: (a b)"),))
+        writer.start()
+        writer.join(0.05)
+        self.assertTrue(writer.is_alive())
+        self.assertEqual(kb.facts, [])
+        kb._lock.release_read()
+        writer.join()
+        self.assertEqual(len(kb.facts), 1)
+        kb.rules.append(read.parse_input("rule: ((a ?x)) -> (c ?x)"))
+        self.assertEqual(kb.rules, [])
+
+    def test_reentrant(self):
+        lock = ReadWriteLock()
+        lock.acquire_write()
+        lock.acquire_read()
+        lock.acquire_write()
+        lock.release_write()
+        lock.release_read()
+        lock.release_write()
+        lock.acquire_read()
+        lock.acquire_read()
+        with self.assertRaises(RuntimeError):
+            lock.acquire_write()
+        lock.release_read()
+        lock.release_read()
+        lock.acquire_write()
+        lock.release_write()
+
+
+class SnapshotViewTest(unittest.TestCase):
+
+    def setUp(self):
+        self.KB = KnowledgeBase([], [])
+        self.KB.bulk_load(read.read_tokenize('statements_kb.txt'))
+
+    def answers(self, kb, query):
+        answer = kb.kb_ask(read.parse_input(query))
+        return [str(answer[i]) for i in range(len(answer))]
+
+    def test_view_ignores_later_changes(self):
+        query = "fact: (inst ?x block)"
+        before = self.answers(self.KB, query)
+        facts, rules = self.KB.facts, list(self.KB.rules)
+        view = self.KB.snapshot()
+        self.KB.kb_retract(read.parse_input("fact: (isa cube block)"))
+        self.KB.kb_retract(read.parse_input("rule: ((inst ?x ?y) (isa ?y ?z)) -> (inst ?x ?z)"))
+        self.KB.kb_assert(read.parse_input("fact: (inst block9 cube)"))
+        self.assertNotEqual(self.answers(self.KB, query), before)
+        self.assertEqual(self.answers(view, query), before)
+        self.assertEqual(view.facts, facts)
+        self.assertEqual(view.rules, rules)
+        self.assertTrue(view.kb_ask(read.parse_input("fact: (isa cube block)")))
+        self.assertFalse(view.kb_ask(read.parse_input("fact: (inst block9 cube)")))
+        conjunction = [read.parse_input("fact: (inst ?x cube)").statement,
+                       read.parse_input("fact: (color ?x red)").statement]
+        self.assertEqual(len(view.kb_ask_conjunction(conjunction)),
+                         len(KnowledgeBase(facts, []).kb_ask_conjunction(conjunction)))
+
+    def test_view_survives_compaction(self):
+        kb = KnowledgeBase([], [])
+        facts = [Fact(['size', 'box%d' % i, 'big']) for i in range(200)]
+        kb.bulk_load(facts)
+        view = kb.snapshot()
+        kb.kb_retract_many(facts[:150])
+        kb.kb_assert(Fact(['size', 'box0', 'big']))
+        self.assertEqual(len(kb.kb_ask(read.parse_input("fact: (size ?x big)"))), 51)
+        self.assertEqual(len(view.kb_ask(read.parse_input("fact: (size ?x big)"))), 200)
+        self.assertEqual(len(view.kb_ask(read.parse_input("fact: (size box7 big)"))), 1)
+
+
+class AsyncKnowledgeBaseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.KB = KnowledgeBase([], [])
+        for i in range(300):
+            self.KB.kb_assert(Rule([[['p%d' % i, '?x']], ['p%d' % (i + 1), '?x']]))
+        self.akb = AsyncKnowledgeBase(self.KB, steps=10)
+        self.query = read.parse_input("fact: (p300 ?x)")
+
+    def test_yields_during_inference(self):
+        seen = []
+        async def watch(task):
+            while not task.done():
+                seen.append(len(await self.akb.ask(self.query)))
+                await asyncio.sleep(0)
+        async def run():
+            task = asyncio.ensure_future(self.akb.assert_(Fact(['p0', 'a'])))
+            await watch(task)
+            await task
+            return await self.akb.ask(self.query)
+        answer = asyncio.run(run())
+        self.assertEqual(str(answer[0]), "?X : a")
+        # the loop ran in between slices, and never saw a partial closure
+        self.assertGreater(len(seen), 10)
+        self.assertEqual(set(seen), set([0]))
+
+    def test_cancel_completes_closure(self):
+        async def run():
+            task = asyncio.ensure_future(self.akb.assert_(Fact(['p0', 'a'])))
+            for _ in range(3):
+                await asyncio.sleep(0)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            answers = []
+            async for bindings, facts in self.akb.ask_iter(self.query):
+                answers.append(bindings)
+            return answers
+        self.assertEqual(len(asyncio.run(run())), 1)
+        self.assertEqual(len(self.KB.facts), 301)
+
+
+class ParallelSaturateTest(unittest.TestCase):
+
+    def test_same_order_as_serial(self):
+        for join_memory in (False, True):
+            serial = KnowledgeBase([], [], engine=InferenceEngine(join_memory))
+            serial.bulk_load(read.read_tokenize('statements_kb.txt'))
+            engine = InferenceEngine(join_memory, processes=2)
+            engine.min_parallel = 0
+            parallel = KnowledgeBase([], [], engine=engine)
+            parallel.bulk_load(read.read_tokenize('statements_kb.txt'))
+            self.assertEqual([(str(f.statement), len(f.supported_by)) for f in parallel.facts],
+                             [(str(f.statement), len(f.supported_by)) for f in serial.facts])
+            self.assertEqual([str(r) for r in parallel.rules], [str(r) for r in serial.rules])
+
+
+class ShardedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.KB = KnowledgeBase([], [])
+        self.KB.bulk_load(read.read_tokenize('statements_kb.txt'))
+        self.sharded = ShardedKnowledgeBase(3)
+        self.sharded.bulk_load(read.read_tokenize('statements_kb.txt'))
+
+    def tearDown(self):
+        self.sharded.close()
+
+    def statements(self, kb):
+        return sorted(str(f.statement) for f in kb.facts)
+
+    def test_same_closure(self):
+        self.assertEqual(self.statements(self.sharded), self.statements(self.KB))
+        for query in ("fact: (inst ?x block)", "fact: (flat cube1)", "fact: (covered ?y)"):
+            answer = self.sharded.kb_ask(read.parse_input(query))
+            expected = self.KB.kb_ask(read.parse_input(query))
+            self.assertEqual(sorted(str(answer[i]) for i in range(len(answer))),
+                             sorted(str(expected[i]) for i in range(len(expected))))
+
+    def test_retract_across_shards(self):
+        for kb in (self.KB, self.sharded):
+            kb.kb_retract(read.parse_input("fact: (isa cube block)"))
+            kb.kb_assert(read.parse_input("fact: (inst block9 cube)"))
+            kb.kb_retract(read.parse_input("fact: (inst cube1 cube)"))
+        self.assertEqual(self.statements(self.sharded), self.statements(self.KB))
+        self.assertFalse(self.sharded.kb_ask(read.parse_input("fact: (flat cube1)")))
+
+    def test_fact_starting_with_variable(self):
+        for kb in (self.KB, self.sharded):
+            kb.kb_assert(read.parse_input("rule: ((likes ?p ?f)) -> (eats ?p ?f)"))
+            kb.kb_assert(read.parse_input("rule: ((likes cube1 ?f)) -> (tasty ?f)"))
+            kb.kb_assert(read.parse_input("fact: (likes ?x pizza)"))
+        self.assertEqual(self.statements(self.sharded), self.statements(self.KB))
+        for query in ("fact: (likes ?y pizza)", "fact: (eats cube1 ?f)", "fact: (tasty ?f)"):
+            answer = self.sharded.kb_ask(read.parse_input(query))
+            expected = self.KB.kb_ask(read.parse_input(query))
+            self.assertEqual(sorted(str(answer[i]) for i in range(len(answer))),
+                             sorted(str(expected[i]) for i in range(len(expected))))
+        for kb in (self.KB, self.sharded):
+            kb.kb_retract(read.parse_input("fact: (likes ?x pizza)"))
+        self.assertEqual(self.statements(self.sharded), self.statements(self.KB))
+
+
+class BulkLoadTest(KBTest):
+
+    def setUp(self):
+        # Load starter facts and rules at once, then saturate
+        file = 'statements_kb4.txt'
+        self.data = read.read_tokenize(file)
+        self.KB = KnowledgeBase([], [])
+        self.KB.bulk_load(self.data)
+
+    def test_same_closure_as_incremental(self):
+        def dump(kb):
+            return sorted((str(f.statement), f.asserted,
+                           sorted(str(x.name) for y in f.supported_by for x in y))
+                          for f in kb.facts)
+        for file in ('statements_kb.txt', 'statements_kb2.txt'):
+            incremental = KnowledgeBase([], [])
+            for item in read.read_tokenize(file):
+                incremental.kb_assert(item)
+            bulk = KnowledgeBase([], [])
+            bulk.bulk_load(read.read_tokenize(file))
+            self.assertEqual(dump(bulk), dump(incremental))
+            self.assertEqual(len(bulk.rules), len(incremental.rules))
+
+
+class InterningTest(unittest.TestCase):
+
+    def test_symbols_are_interned(self):
+        self.assertIs(Constant('cube'), Constant('cube'))
+        self.assertIs(Term('?x'), Term(Variable('?x')))
+        self.assertLess(Term('?x').id, 0)
+        self.assertGreaterEqual(Term('cube').id, 0)
+        self.assertEqual(symbol(symbol_id('cube')), Constant('cube'))
+
+    def test_statements_hash_by_key(self):
+        f1 = read.parse_input("fact: (isa cube block)")
+        f2 = Fact(Statement(['isa', Term('cube'), 'block']))
+        self.assertEqual(f1.statement.key, f2.statement.key)
+        self.assertEqual(len(set([f1, f2])), 1)
+        self.assertNotEqual(f1, read.parse_input("fact: (isa block cube)"))
+        self.assertEqual(repr(f1.statement),
+                         "Statement('isa', [Term(Constant('cube')), Term(Constant('block'))])")
+        self.assertEqual(str(f1.statement), "(isa cube block)")
+
+    def test_pickle_by_value(self):
+        import pickle
+        rule = read.parse_input("rule: ((inst ?x ?y) (isa ?y ?z)) -> (inst ?x ?z)")
+        copy = pickle.loads(pickle.dumps(rule))
+        self.assertEqual(copy, rule)
+        self.assertIs(copy.lhs[0].terms[0], rule.lhs[0].terms[0])
+
+    def test_variable_predicate(self):
+        kb = KnowledgeBase([], [])
+        kb.kb_assert(read.parse_input("rule: ((p ?x)) -> (?q ?x)"))
+        kb.kb_assert(read.parse_input("fact: (p a)"))
+        self.assertEqual([str(f.statement) for f in kb.facts], ['(p a)', '(?q a)'])
+
+    def test_empty_statement(self):
+        statement = Statement()
+        self.assertEqual(statement.predicate, '')
+        self.assertEqual(statement.terms, ())
+        self.assertEqual(Statement([]), statement)
+
+    def test_threads_intern_once(self):
+        names = ['racer%d' % i for i in range(500)]
+        found = [[] for _ in range(4)]
+        def intern(symbols):
+            for name in names:
+                symbols.append(Constant(name))
+        threads = [threading.Thread(target=intern, args=(symbols,)) for symbols in found]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for symbols in found[1:]:
+            self.assertTrue(all(x is y for x, y in zip(symbols, found[0])))
+        self.assertEqual(len(set(x.id for x in found[0])), len(names))
+        self.assertTrue(all(symbol(x.id) is x for x in found[0]))
+
+
+class PatternTest(unittest.TestCase):
+
+    def test_compiled_match(self):
+        pattern = compile_pattern(Statement(['rel', '?x', 'b', '?x', '?y']))
+        key = Statement(['rel', 'a', 'b', 'a', 'c']).key
+        self.assertEqual(pattern.match(key), (symbol_id('a'), symbol_id('c')))
+        self.assertIsNone(pattern.match(Statement(['rel', 'a', 'b', 'd', 'c']).key))
+        self.assertIsNone(pattern.match(Statement(['rel', 'a', 'z', 'a', 'c']).key))
+        self.assertIsNone(pattern.match(Statement(['rel', 'a', 'b']).key))
+        self.assertIs(compile_pattern(Statement(['rel', '?x', 'b', '?x', '?y'])), pattern)
+
+    def test_match_both_ways(self):
+        ground = Statement(['color', 'bigbox', 'red'])
+        self.assertEqual(str(match(Statement(['color', '?x', 'red']), ground)),
+                         "?X : bigbox")
+        # variables on the second statement go through the general matcher
+        self.assertEqual(str(match(ground, Statement(['color', 'bigbox', '?c']))),
+                         "?C : red")
+        self.assertFalse(match(Statement(['color', '?x', '?x']), ground))
+
+
+class BindingsTest(unittest.TestCase):
+
+    def test_slots_keep_str_and_getitem(self):
+        bindings = match(Statement(['color', '?x', '?y']),
+                         Statement(['color', 'bigbox', 'red']))
+        self.assertEqual(str(bindings), "?X : bigbox, ?Y : red")
+        self.assertEqual(bindings['?y'], 'red')
+        self.assertIsNone(bindings['?z'])
+        self.assertEqual(bindings.bindings_dict, {'?x': 'bigbox', '?y': 'red'})
+        self.assertIs(bindings.bound_to(Variable('?x')), Constant('bigbox'))
+        self.assertEqual(str(Bindings()), "No bindings")
+
+    def test_copy_and_undo(self):
+        bindings = match(Statement(['on', '?x']), Statement(['on', 'a']))
+        other = bindings.copy()
+        mark = other.mark()
+        other.add_binding(Variable('?y'), Constant('b'))
+        self.assertEqual(str(other), "?X : a, ?Y : b")
+        self.assertEqual(str(bindings), "?X : a")
+        self.assertFalse(bindings.bound_to(Variable('?y')))
+        other.undo(mark)
+        self.assertEqual(str(other), "?X : a")
+        self.assertTrue(other.test_and_bind(Term('?y'), Term('c')))
+        self.assertFalse(other.test_and_bind(Term('?y'), Term('d')))
+        # the pattern that made the bindings is left untouched
+        again = match(Statement(['on', '?x']), Statement(['on', 'e']))
+        self.assertEqual(str(again), "?X : e")
+
+
+class AskIterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.KB = KnowledgeBase([], [])
+        for item in read.read_tokenize('statements_kb.txt'):
+            self.KB.kb_assert(item)
+        self.ask = read.parse_input("fact: (inst ?x ?y)")
+
+    def test_limit_and_offset(self):
+        everything = self.KB.kb_ask(self.ask)
+        page = self.KB.kb_ask(self.ask, limit=5, offset=10)
+        self.assertEqual(len(page), 5)
+        self.assertEqual([str(page[i]) for i in range(5)],
+                         [str(everything[i]) for i in range(10, 15)])
+        self.assertEqual(len(self.KB.kb_ask(self.ask, offset=len(everything))), 0)
+
+    def test_iter_is_lazy(self):
+        answers = self.KB.kb_ask_iter(self.ask)
+        bindings, facts = next(answers)
+        self.assertEqual(str(bindings), "?X : bigbox, ?Y : box")
+        self.assertEqual(str(facts[0].statement), "(inst bigbox box)")
+        # the KB can change while an iteration is running
+        self.KB.kb_assert(read.parse_input("fact: (inst cube5 cube)"))
+        self.KB.kb_retract(read.parse_input("fact: (inst littlebox box)"))
+        bindings, facts = next(answers)
+        self.assertEqual(str(facts[0].statement), "(inst pyramid1 pyramid)")
+        self.assertEqual(len(list(self.KB.kb_ask_iter(self.ask, limit=3))), 3)
+
+
+class ConjunctionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.KB = KnowledgeBase([], [])
+        for item in read.read_tokenize('statements_kb.txt'):
+            self.KB.kb_assert(item)
+
+    def test_join(self):
+        answer = self.KB.kb_ask_conjunction([
+            read.parse_input("fact: (inst ?x pyramid)"),
+            read.parse_input("fact: (color ?x red)")])
+        self.assertEqual([str(answer[i]) for i in range(len(answer))],
+                         ["?X : pyramid3", "?X : pyramid4"])
+        facts = answer.list_of_bindings[0][1]
+        self.assertEqual([str(f.statement) for f in facts],
+                         ["(inst pyramid3 pyramid)", "(color pyramid3 red)"])
+
+    def test_plan_starts_selective(self):
+        statements = [Statement(['inst', '?x', '?y']), Statement(['isa', '?y', 'block']),
+                      Statement(['size', '?x', 'big'])]
+        patterns = [compile_pattern(s) for s in statements]
+        self.assertEqual(self.KB._plan_conjunction(statements, patterns), [1, 0, 2])
+        answer = self.KB.kb_ask_conjunction(statements)
+        self.assertEqual(str(answer[0]), "?X : pyramid3, ?Y : pyramid")
+        self.assertEqual(len(answer), 2)
+        self.assertFalse(self.KB.kb_ask_conjunction(
+            [Statement(['inst', '?x', 'pyramid']), Statement(['color', '?x', 'purple'])]))
+
+
 def pprint_justification(answer):
     """Pretty prints (hence pprint) justifications for the answer.
     """
@@ -1,5 +1,170 @@
+import mmap, os, re
+import multiprocessing
 from logical_classes import *
 
+# Tokens of the statements files: comments, headers, arrows, parentheses and
+# terms. Every character but whitespace is part of a token.
+_TOKEN = re.compile(r"#.*|fact:|rule:|->|[()]|[^\s()#]+")
+
+# Whole lines holding a single rule, parsed without the state machine
+_RULE_LINE = re.compile(r"\s*rule:\s*\(((?:\s*\([^()#]*\))+)\s*\)\s*->\s*\(([^()#]*)\)\s*$")
+_STATEMENT = re.compile(r"\(([^()]*)\)")
+
+# Tokens that are not terms
+_PUNCTUATION = frozenset(('fact:', 'rule:', '->', '(', ')'))
+
+# States of the parser
+_HEADER, _FACT, _RULE, _LHS_FIRST, _LHS, _ARROW, _RHS, _TERMS = range(8)
+
+# What each state of the parser expects next, for errors
+_EXPECTED = {
+    _HEADER: "'fact:' or 'rule:'",
+    _FACT: "'('",
+    _RULE: "'('",
+    _LHS_FIRST: "'(' or a term",
+    _LHS: "'(' or ')'",
+    _ARROW: "'->'",
+    _RHS: "'('",
+    _TERMS: "')' or a term",
+}
+
+class ParseError(ValueError):
+    """Error in the text of a fact or rule
+
+    Attributes:
+        message (str): what is wrong
+        line (int): line of the error, starting at 1
+        column (int): column of the error, starting at 1
+    """
+    def __init__(self, message, line, column):
+        """Constructor for ParseError
+
+        Args:
+            message (str): what is wrong
+            line (int): line of the error
+            column (int): column of the error
+        """
+        super(ParseError, self).__init__(
+            "line {}, column {}: {}".format(line, column, message))
+        self.message = message
+        self.line = line
+        self.column = column
+
+
+def _error(message, line, number, index):
+    """INTERNAL USE ONLY
+    ParseError at the index-th token of a line, its column is only computed
+    when there is an error
+    """
+    tokens = list(_TOKEN.finditer(line))
+    column = tokens[index].start() + 1 if index < len(tokens) else len(line.rstrip()) + 1
+    return ParseError(message, number, column)
+
+def parse_lines(lines, first_line=1):
+    """Parse facts and rules from lines of text in a single pass, yielding each
+        one as soon as it is read. A fact is `fact:` followed by a statement, a
+        rule is `rule:` followed by its LHS statements between parentheses (or
+        a single LHS statement), `->` and its RHS statement. They may span
+        several lines, and `#` starts a comment running to the end of the line.
+        A line holding a whole fact or rule is parsed by a regular expression,
+        anything else is split into tokens that a state machine walks.
+
+    Args:
+        lines (iterable of str): text to parse, e.g. an open file
+        first_line (int): number of the first line, used in errors
+
+    Returns:
+        iterator of Fact|Rule
+
+    Raises:
+        ParseError: if the text is not a sequence of facts and rules
+    """
+    state = _HEADER
+    after = None
+    terms = lhs = None
+    number, line = first_line, ''
+    for number, line in enumerate(lines, first_line):
+        if state == _HEADER:
+            if line.startswith('fact:'):
+                body = line[5:].strip()
+                inner = body[1:-1]
+                if body[:1] == '(' and body[-1:] == ')' and '(' not in inner and \
+                        ')' not in inner and '#' not in inner:
+                    terms = inner.split()
+                    if terms:
+                        yield Fact(terms)
+                        continue
+            match = _RULE_LINE.match(line)
+            if match:
+                lhs = [statement.split() for statement in _STATEMENT.findall(match.group(1))]
+                terms = match.group(2).split()
+                if terms and all(lhs):
+                    yield Rule([lhs, terms])
+                    continue
+        index = -1
+        for token in _TOKEN.findall(line):
+            index += 1
+            first = token[0]
+            if first == '#':
+                break
+            if state == _TERMS:
+                if token not in _PUNCTUATION:
+                    terms.append(token)
+                    continue
+                if token == ')':
+                    if not terms:
+                        raise _error("empty statement", line, number, index)
+                    state = after
+                    if state == _HEADER:
+                        yield Fact(terms)
+                    elif state == _LHS:
+                        lhs.append(terms)
+                    elif state == _ARROW:
+                        lhs = [terms]
+                    else:
+                        yield Rule([lhs, terms])
+                        state = _HEADER
+                    continue
+            elif state == _HEADER:
+                if token == 'fact:':
+                    state = _FACT
+                    continue
+                if token == 'rule:':
+                    state = _RULE
+                    continue
+            elif token == '(':
+                if state == _FACT:
+                    state, after, terms = _TERMS, _HEADER, []
+                    continue
+                if state == _RULE:
+                    state = _LHS_FIRST
+                    continue
+                if state == _LHS_FIRST:
+                    lhs = []
+                    state, after, terms = _TERMS, _LHS, []
+                    continue
+                if state == _LHS:
+                    state, after, terms = _TERMS, _LHS, []
+                    continue
+                if state == _RHS:
+                    state, after, terms = _TERMS, _RHS, []
+                    continue
+            elif state == _LHS and token == ')':
+                state = _ARROW
+                continue
+            elif state == _ARROW and token == '->':
+                state = _RHS
+                continue
+            elif state == _LHS_FIRST and token not in _PUNCTUATION:
+                # a single LHS statement may omit the enclosing parentheses
+                state, after, terms = _TERMS, _ARROW, [token]
+                continue
+            raise _error("unexpected {!r}, expected {}".format(token, _EXPECTED[state]),
+                         line, number, index)
+    if state != _HEADER:
+        raise ParseError("unexpected end of input, expected " + _EXPECTED[state],
+                         number, len(line.rstrip()) + 1)
+
 # read_tokenize takes the name of a file, reads it in and tokenizes the
 # statements and rules in that file.
 def read_tokenize(file):
@@ -16,22 +181,141 @@ def read_tokenize(file):
     Returns:
         A list of Facts and Rules.
     """
-    file = open(file, "r")
-    elements = []
-    current = ""
-    for line in file:
-        if line[0:5] in ("fact:", "rule:"):
-            elements.append(current)
-            current = line.rstrip()
+    return list(read_tokenize_iter(file))
+
+def read_tokenize_iter(file):
+    """Lazily read the facts and rules of a file, see `parse_lines`
+
+    Args:
+        file (str): name of a statements file
+
+    Returns:
+        iterator of Fact|Rule
+
+    Raises:
+        ParseError: if the file is not a sequence of facts and rules
+    """
+    with open(file, "r") as lines:
+        for fact_rule in parse_lines(lines):
+            yield fact_rule
+
+
+def _chunks(data, chunk_size):
+    """INTERNAL USE ONLY
+    (start, end) offsets splitting data into chunks of about chunk_size bytes,
+    each starting at a line beginning with 'fact:' or 'rule:'
+    """
+    chunks = []
+    start = 0
+    while start < len(data):
+        end = start + chunk_size
+        if end >= len(data):
+            end = len(data)
         else:
-            current = current + " " + line.rstrip().strip()
-    elements.append(current)
+            found = [position for position in (data.find(b"\nfact:", end),
+                                               data.find(b"\nrule:", end))
+                     if position >= 0]
+            end = min(found) + 1 if found else len(data)
+        chunks.append((start, end))
+        start = end
+    return chunks
+
+def _parse_chunk(task):
+    """INTERNAL USE ONLY
+    Parse a chunk of a statements file in a worker process into symbol id
+    tuples over a symbol table local to the chunk, as symbol ids of one process
+    are meaningless in another.
+
+    Args:
+        task ((str, int, int)): file name, start and end offsets of the chunk
+
+    Returns:
+        (listof str, listof tuple, int, tuple|None): names of the symbols, then
+            ('fact', key) and ('rule', lhs keys, rhs key) records, number of
+            lines of the chunk, and (message, line, column) of a parse error
+    """
+    file, start, end = task
+    with open(file, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            text = data[start:end].decode("utf-8")
+        finally:
+            data.close()
+    symbols = []
+    local = {}
+    def convert(statement):
+        key = []
+        for sid in statement.key:
+            index = local.get(sid)
+            if index is None:
+                index = local[sid] = len(symbols)
+                symbols.append(symbol(sid).element)
+            key.append(index)
+        return tuple(key)
+    records = []
+    error = None
+    try:
+        for fact_rule in parse_lines(text.splitlines(True)):
+            if isinstance(fact_rule, Fact):
+                records.append(('fact', convert(fact_rule.statement)))
+            else:
+                records.append(('rule', tuple(convert(statement) for statement in fact_rule.lhs),
+                                convert(fact_rule.rhs)))
+    except ParseError as e:
+        error = (e.message, e.line, e.column)
+    return symbols, records, text.count("\n"), error
+
+def read_parallel(file, processes=None, chunk_size=1 << 22):
+    """Read the facts and rules of a large statements file using every core.
+        The file is memory-mapped and split into chunks of about chunk_size
+        bytes at 'fact:'/'rule:' lines. A process pool parses the chunks into
+        symbol id tuples, and the results are turned back into facts and rules
+        in file order. Small files, a single process, or a platform without
+        process pools fall back to `read_tokenize`.
+
+    Args:
+        file (str): name of a statements file
+        processes (int|None): number of worker processes, defaults to the
+            number of CPUs
+        chunk_size (int): approximate size of a chunk in bytes
+
+    Returns:
+        listof Fact|Rule: same as read_tokenize(file)
+
+    Raises:
+        ParseError: if the file is not a sequence of facts and rules
+    """
+    processes = processes or os.cpu_count() or 1
+    if processes == 1 or os.path.getsize(file) <= chunk_size:
+        return read_tokenize(file)
+    with open(file, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            chunks = _chunks(data, chunk_size)
+        finally:
+            data.close()
+    try:
+        pool = multiprocessing.Pool(min(processes, len(chunks)))
+    except (OSError, ImportError):
+        return read_tokenize(file)
     output = []
-    for e in elements:
-        parsed = parse_input(e)
-        if isinstance(parsed, Fact) or isinstance(parsed, Rule):
-            output.append(parsed)
-    file.close()
+    line = 0
+    with pool:
+        for symbols, records, lines, error in pool.imap(
+                _parse_chunk, [(file, start, end) for start, end in chunks]):
+            if error is not None:
+                message, error_line, column = error
+                raise ParseError(message, line + error_line, column)
+            ids = [symbol_id(symbol) for symbol in symbols]
+            def statement(key):
+                return Statement.from_key(tuple([ids[index] for index in key]))
+            for record in records:
+                if record[0] == 'fact':
+                    output.append(Fact(statement(record[1])))
+                else:
+                    output.append(Rule([[statement(key) for key in record[1]],
+                                        statement(record[2])]))
+            line += lines
     return output
 
 
@@ -42,27 +326,20 @@ def parse_input(e):
         e (string): Input string to parse
 
     Returns:
-        (number, string | listof string): label, then parsed input
+        Fact|Rule|str|None: the fact or rule, the text of a comment, or None
+            for a blank input
+
+    Raises:
+        ParseError: if the input is not a single fact or rule
     """
-    if len(e) == 0:
-        #return (BLANK, None)
+    if len(e.strip()) == 0:
         return None
     elif e[0] == '#':
-        #return (COMMENT, e)
         return e[1:]
-    elif e[0:5] == "fact:":
-        e = e[5:].replace(")", "").replace("(", "").rstrip().strip().split()
-        #return (FACT, e)
-        return Fact(e)
-    elif e[0:5] == "rule:":
-        e = e[5:].split("->")
-        rhs = e[1].replace(")", "").replace("(", "").rstrip().strip().split()
-        lhs = e[0].rstrip(") ").strip("( ").replace("(", "").split(")")
-        lhs = map(lambda x: x.rstrip().strip().split(), lhs)
-        #return (RULE, [lhs, rhs])
-        return Rule([lhs, rhs])
-    else:
-        print("PARSE ERROR: input header", e[0:5], "not recognized.")
+    parsed = list(parse_lines(e.splitlines()))
+    if len(parsed) != 1:
+        raise ParseError("expected a single fact or rule, got {}".format(len(parsed)), 1, 1)
+    return parsed[0]
 
 def get_new_fact_or_rule():
     """Creates a new fact or rule. (instead of args, we use command line input
@@ -0,0 +1,502 @@
+from logical_classes import *
+
+class AlphaMemory(object):
+    """Facts matching one LHS pattern, shared by every rule using an equivalent
+        pattern. A pattern is reduced to its predicate, its constants and the
+        positions of its distinct variables; matching a fact yields the symbol
+        ids bound to those variables in order of first occurrence.
+
+    Attributes:
+        predicate (str): predicate of the pattern
+        items (dictof (Fact, tuple)): matched facts with their variable values,
+            keyed by fact identity
+        successors (listof JoinNode): join nodes fed by this memory, deepest first
+    """
+    def __init__(self, predicate, arity, constants, variables, repeats):
+        """Constructor for AlphaMemory
+
+        Args:
+            predicate (str): predicate of the pattern
+            arity (int): number of terms of the pattern
+            constants (tupleof (int, int)): (position, symbol id) of constants,
+                positions being indexes into `Statement.key`
+            variables (tupleof int): position of the first occurrence of each
+                distinct variable
+            repeats (tupleof (int, int)): (position, variable index) of every
+                later occurrence of a variable
+        """
+        self.predicate = predicate
+        self.arity = arity
+        self.constants = constants
+        self.variables = variables
+        self.repeats = repeats
+        self.items = {}
+        self.successors = []
+        self._indexes = {}
+
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return 'AlphaMemory({!r}, {!r}, {!r}, {!r})'.format(
+            self.predicate, self.arity, self.constants, self.variables)
+
+    def match(self, statement):
+        """Match a fact statement against the pattern of this memory
+
+        Args:
+            statement (Statement): statement of the fact
+
+        Returns:
+            tuple|None: values of the pattern's variables, None if no match
+        """
+        key = statement.key
+        if len(key) != self.arity + 1:
+            return None
+        for position, constant in self.constants:
+            if key[position] != constant:
+                return None
+        values = tuple(key[position] for position in self.variables)
+        for position, index in self.repeats:
+            if key[position] != values[index]:
+                return None
+        return values
+
+    def insert(self, fact, values):
+        """Store a matching fact and its variable values"""
+        item = (fact, values)
+        self.items[id(fact)] = item
+        for variables, index in self._indexes.items():
+            key = tuple(values[i] for i in variables)
+            index.setdefault(key, {})[id(fact)] = item
+
+    def remove(self, fact):
+        """Drop a fact from this memory, returns whether it was stored"""
+        item = self.items.pop(id(fact), None)
+        if item is None:
+            return False
+        for variables, index in self._indexes.items():
+            key = tuple(item[1][i] for i in variables)
+            bucket = index[key]
+            del bucket[id(fact)]
+            if not bucket:
+                del index[key]
+        return True
+
+    def lookup(self, variables, key):
+        """Stored (fact, values) items whose values at the given variable
+            indexes equal key, hash-indexed on first use of those indexes
+
+        Args:
+            variables (tupleof int): indexes into the values of each item
+            key (tuple): values expected at those indexes
+
+        Returns:
+            listof (Fact, tuple)
+        """
+        if not variables:
+            return list(self.items.values())
+        index = self._indexes.get(variables)
+        if index is None:
+            index = {}
+            for item in self.items.values():
+                k = tuple(item[1][i] for i in variables)
+                index.setdefault(k, {})[id(item[0])] = item
+            self._indexes[variables] = index
+        return list(index.get(key, {}).values())
+
+
+class Token(object):
+    """Partial match of a rule LHS: the fact matching the last joined pattern,
+        the token matching the patterns before it and the values of every
+        variable bound so far, indexed by slot.
+    """
+    __slots__ = ('parent', 'fact', 'values', 'node', 'children')
+
+    def __init__(self, parent, fact, values, node):
+        self.parent = parent
+        self.fact = fact
+        self.values = values
+        self.node = node
+        self.children = []
+
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return 'Token({!r}, {!r})'.format(self.facts(), self.values)
+
+    def facts(self):
+        """Facts of this partial match, in LHS order
+
+        Returns:
+            listof Fact
+        """
+        facts = []
+        token = self
+        while token is not None:
+            facts.append(token.fact)
+            token = token.parent
+        facts.reverse()
+        return facts
+
+
+class JoinNode(object):
+    """Joins the tokens of a parent node with the facts of an alpha memory on
+        the variables they share, and keeps the resulting tokens (the beta
+        memory). Nodes are shared by every rule whose LHS starts with the same
+        patterns up to variable renaming.
+
+    Attributes:
+        parent (JoinNode|None): node joining the previous patterns, None for
+            the first pattern of a LHS
+        alpha (AlphaMemory): memory of the pattern joined by this node
+        tests (tupleof (int, int)): (alpha variable index, parent slot) pairs
+            that must hold equal values
+        new (tupleof int): alpha variable indexes appended as new slots
+        tokens (dictof Token): tokens of this node keyed by (parent, fact) ids
+        children (listof JoinNode): nodes joining the next pattern
+        terminals (listof (Rule, tuple)): rules completed by this node with
+            their RHS templates, a (slot or None, symbol id) pair per term
+    """
+    def __init__(self, parent, alpha, tests, new):
+        self.parent = parent
+        self.alpha = alpha
+        self.tests = tests
+        self.new = new
+        self.depth = parent.depth + 1 if parent else 1
+        self.tokens = {}
+        self.children = []
+        self.terminals = []
+        self._indexes = {}
+        self._alpha_vars = tuple(i for i, _ in tests)
+        self._parent_slots = tuple(s for _, s in tests)
+
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return 'JoinNode({!r}, {!r}, {!r})'.format(self.alpha, self.tests, self.new)
+
+    def add_token(self, token):
+        """Store a token, returns False if the same match is already stored"""
+        key = (id(token.parent), id(token.fact))
+        if key in self.tokens:
+            return False
+        self.tokens[key] = token
+        for slots, index in self._indexes.items():
+            k = tuple(token.values[s] for s in slots)
+            index.setdefault(k, {})[key] = token
+        return True
+
+    def remove_token(self, token):
+        """Drop a token from this node"""
+        key = (id(token.parent), id(token.fact))
+        if self.tokens.pop(key, None) is None:
+            return
+        for slots, index in self._indexes.items():
+            k = tuple(token.values[s] for s in slots)
+            bucket = index[k]
+            del bucket[key]
+            if not bucket:
+                del index[k]
+
+    def lookup(self, slots, key):
+        """Tokens whose values at the given slots equal key, hash-indexed on
+            first use of those slots
+
+        Returns:
+            listof Token
+        """
+        if not slots:
+            return list(self.tokens.values())
+        index = self._indexes.get(slots)
+        if index is None:
+            index = {}
+            for k, token in self.tokens.items():
+                index.setdefault(tuple(token.values[s] for s in slots), {})[k] = token
+            self._indexes[slots] = index
+        return list(index.get(key, {}).values())
+
+
+class ReteEngine(object):
+    """Forward chainer compiling the rules of a KnowledgeBase into a Rete
+        network. Each LHS pattern has an alpha memory holding the facts matching
+        it and each LHS prefix a join node holding its partial matches as
+        tokens, so adding a fact only joins it with the stored partial matches
+        instead of deriving curried rules. Inferred facts are supported by the
+        rule and every fact of the match, e.g. [rule, fact1, fact2]; only
+        asserted rules are ever stored in `kb.rules`.
+    """
+    def __init__(self):
+        """Constructor for ReteEngine creating an empty network
+        """
+        super(ReteEngine, self).__init__()
+        self._alphas = {}
+        self._alphas_by_predicate = {}
+        self._nodes = {}
+        self._tokens_by_fact = {}
+        self._terminal_of = {}
+        self._restoring = False
+
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return 'ReteEngine({} alpha memories, {} join nodes)'.format(
+            len(self._alphas), len(self._nodes))
+
+    def fact_added(self, fact, kb):
+        """Propagate a fact just added to the KB through the network
+
+        Args:
+            fact (Fact) - the added fact
+            kb (KnowledgeBase) - the KnowledgeBase it was added to
+        """
+        for alpha in self._alphas_by_predicate.get(fact.statement.predicate, ()):
+            values = alpha.match(fact.statement)
+            if values is None:
+                continue
+            alpha.insert(fact, values)
+            for node in list(alpha.successors):
+                self._right_activate(node, fact, values, kb)
+
+    def saturate(self, facts, rules, kb):
+        """Propagate facts and rules stored in the KB without inference. Token
+            memories already make every join semi-naive: the facts are pushed
+            through the existing network, then the new rules are compiled,
+            which seeds their new memories from the store.
+
+        Args:
+            facts (listof Fact) - facts stored without inference
+            rules (listof Rule) - rules stored without inference
+            kb (KnowledgeBase) - the KnowledgeBase they are stored in
+        """
+        for fact in facts:
+            self.fact_added(fact, kb)
+        for rule in rules:
+            self.rule_added(rule, kb)
+
+    def restore(self, kb):
+        """Rebuild the network for a KB restored from a snapshot: the rules are
+            compiled and their memories seeded from the store, without firing,
+            as everything they infer was restored with its supports
+
+        Args:
+            kb (KnowledgeBase) - the restored KnowledgeBase
+        """
+        self._restoring = True
+        try:
+            for rule in kb.rules:
+                self.rule_added(rule, kb)
+        finally:
+            self._restoring = False
+
+    def fact_removed(self, fact, kb):
+        """Drop a fact removed from the KB from the alpha memories, along with
+            every partial match it takes part in
+
+        Args:
+            fact (Fact) - the removed fact
+            kb (KnowledgeBase) - the KnowledgeBase it was removed from
+        """
+        for alpha in self._alphas_by_predicate.get(fact.statement.predicate, ()):
+            alpha.remove(fact)
+        for token in list(self._tokens_by_fact.pop(id(fact), {}).values()):
+            self._delete_token(token)
+
+    def rule_added(self, rule, kb):
+        """Compile a rule just added to the KB into the network and infer from
+            the partial matches already stored
+
+        Args:
+            rule (Rule) - the added rule
+            kb (KnowledgeBase) - the KnowledgeBase it was added to
+        """
+        node = None
+        slots = {}
+        for statement in rule.lhs:
+            alpha, names = self._alpha_memory(statement, kb)
+            tests = []
+            new = []
+            for index, name in enumerate(names):
+                if name in slots:
+                    tests.append((index, slots[name]))
+                else:
+                    slots[name] = len(slots)
+                    new.append(index)
+            node = self._join_node(node, alpha, tuple(tests), tuple(new), kb)
+        template = tuple((slots.get(symbol), symbol) for symbol in rule.rhs.key[1:])
+        terminal = (rule, template)
+        node.terminals.append(terminal)
+        self._terminal_of[id(rule)] = node
+        for token in list(node.tokens.values()):
+            self._fire(terminal, token, kb)
+
+    def rule_removed(self, rule, kb):
+        """Remove a rule from the network, dropping the nodes and memories no
+            other rule uses
+
+        Args:
+            rule (Rule) - the removed rule
+            kb (KnowledgeBase) - the KnowledgeBase it was removed from
+        """
+        node = self._terminal_of.pop(id(rule), None)
+        if node is None:
+            return
+        node.terminals = [t for t in node.terminals if t[0] is not rule]
+        while node is not None and not node.terminals and not node.children:
+            for token in list(node.tokens.values()):
+                self._delete_token(token)
+            del self._nodes[self._node_key(node.parent, node.alpha, node.tests, node.new)]
+            node.alpha.successors.remove(node)
+            if not node.alpha.successors:
+                self._drop_alpha(node.alpha)
+            parent = node.parent
+            if parent is not None:
+                parent.children.remove(node)
+            node = parent
+
+    def _alpha_memory(self, statement, kb):
+        """INTERNAL USE ONLY
+        Get or create the alpha memory of a LHS statement
+
+        Returns:
+            (AlphaMemory, listof int): the memory and the symbol ids of the
+                distinct variables of the statement, in the order of its values
+        """
+        constants = []
+        variables = []
+        repeats = []
+        names = []
+        key = statement.key
+        for position in range(1, len(key)):
+            symbol = key[position]
+            if symbol >= 0:
+                constants.append((position, symbol))
+            elif symbol in names:
+                repeats.append((position, names.index(symbol)))
+            else:
+                names.append(symbol)
+                variables.append(position)
+        key = (statement.predicate, len(statement.terms), tuple(constants),
+               tuple(variables), tuple(repeats))
+        alpha = self._alphas.get(key)
+        if alpha is None:
+            alpha = AlphaMemory(*key)
+            self._alphas[key] = alpha
+            self._alphas_by_predicate.setdefault(statement.predicate, []).append(alpha)
+            for fact in kb._facts.candidates(statement):
+                values = alpha.match(fact.statement)
+                if values is not None:
+                    alpha.insert(fact, values)
+        return alpha, names
+
+    def _drop_alpha(self, alpha):
+        """INTERNAL USE ONLY
+        Forget an alpha memory no join node uses anymore
+        """
+        key = (alpha.predicate, alpha.arity, alpha.constants, alpha.variables,
+               alpha.repeats)
+        del self._alphas[key]
+        alphas = self._alphas_by_predicate[alpha.predicate]
+        alphas.remove(alpha)
+        if not alphas:
+            del self._alphas_by_predicate[alpha.predicate]
+
+    def _node_key(self, parent, alpha, tests, new):
+        """INTERNAL USE ONLY
+        Key under which a join node is shared
+        """
+        return (id(parent), id(alpha), tests, new)
+
+    def _join_node(self, parent, alpha, tests, new, kb):
+        """INTERNAL USE ONLY
+        Get or create the join node of a parent node and an alpha memory,
+        filling the beta memory of a new node from the stored matches
+        """
+        key = self._node_key(parent, alpha, tests, new)
+        node = self._nodes.get(key)
+        if node is not None:
+            return node
+        node = JoinNode(parent, alpha, tests, new)
+        self._nodes[key] = node
+        if parent is not None:
+            parent.children.append(node)
+        # deeper nodes first so that a fact feeding two nodes of the same
+        # chain is never joined with itself twice
+        alpha.successors.append(node)
+        alpha.successors.sort(key=lambda n: -n.depth)
+        if parent is None:
+            for fact, values in alpha.lookup((), ()):
+                self._new_token(node, None, fact, values, kb)
+        else:
+            for token in list(parent.tokens.values()):
+                self._left_activate(node, token, kb)
+        return node
+
+    def _right_activate(self, node, fact, values, kb):
+        """INTERNAL USE ONLY
+        Join a fact newly stored in the node's alpha memory with the tokens of
+        the node's parent
+        """
+        if node.parent is None:
+            self._new_token(node, None, fact, values, kb)
+            return
+        key = tuple(values[i] for i in node._alpha_vars)
+        for token in node.parent.lookup(node._parent_slots, key):
+            self._new_token(node, token, fact, values, kb)
+
+    def _left_activate(self, node, token, kb):
+        """INTERNAL USE ONLY
+        Join a token newly stored in the node's parent with the facts of the
+        node's alpha memory
+        """
+        key = tuple(token.values[s] for s in node._parent_slots)
+        for fact, values in node.alpha.lookup(node._alpha_vars, key):
+            self._new_token(node, token, fact, values, kb)
+
+    def _new_token(self, node, parent, fact, values, kb):
+        """INTERNAL USE ONLY
+        Store the token extending parent with fact in node and propagate it
+        """
+        base = parent.values if parent is not None else ()
+        token = Token(parent, fact, base + tuple(values[i] for i in node.new), node)
+        if not node.add_token(token):
+            return
+        if parent is not None:
+            parent.children.append(token)
+        self._tokens_by_fact.setdefault(id(fact), {})[id(token)] = token
+        for child in list(node.children):
+            self._left_activate(child, token, kb)
+        for terminal in list(node.terminals):
+            self._fire(terminal, token, kb)
+
+    def _delete_token(self, token):
+        """INTERNAL USE ONLY
+        Drop a token and every token extending it
+        """
+        stack = [token]
+        while stack:
+            token = stack.pop()
+            token.node.remove_token(token)
+            tokens = self._tokens_by_fact.get(id(token.fact))
+            if tokens is not None:
+                tokens.pop(id(token), None)
+                if not tokens:
+                    del self._tokens_by_fact[id(token.fact)]
+            parent = token.parent
+            if parent is not None and token in parent.children:
+                parent.children.remove(token)
+            stack.extend(token.children)
+            token.children = []
+
+    def _fire(self, terminal, token, kb):
+        """INTERNAL USE ONLY
+        Infer the RHS of a rule from a complete match of its LHS
+        """
+        if self._restoring:
+            return
+        rule, template = terminal
+        values = token.values
+        facts = token.facts()
+        statement = Statement.from_key((rule.rhs.key[0],) + tuple(
+            symbol if slot is None else values[slot] for slot, symbol in template))
+        newfact = Fact(statement, [[rule] + facts])
+        kb.kb_add(newfact)
@@ -0,0 +1,359 @@
+import multiprocessing, zlib
+from logical_classes import *
+from util import *
+from function import KnowledgeBase
+import wal
+
+verbose = 0
+
+def _shard_of(predicate, first, count):
+    """INTERNAL USE ONLY
+    Shard owning the facts with the given predicate and first term. A CRC is
+    used instead of `hash`, which differs from one process to another.
+    """
+    return zlib.crc32((predicate + ' ' + first).encode('utf-8')) % count
+
+def _route(statement, count):
+    """INTERNAL USE ONLY
+    Shard owning the facts a statement matches, None if its first term is a
+    variable so that they may be on any shard
+    """
+    key = statement.key
+    if len(key) > 1 and key[1] < 0:
+        return None
+    first = symbol(key[1]).element if len(key) > 1 else ''
+    return _shard_of(symbol(key[0]).element, first, count)
+
+
+class _Shard(KnowledgeBase):
+    """INTERNAL USE ONLY
+    KnowledgeBase of one worker process of a ShardedKnowledgeBase. Facts and
+    rules inferred here that belong to other shards are put in `outbox`
+    instead of being added, and facts and rules of other shards taking part in
+    the justifications of local ones are represented by stubs, i.e. copies
+    that are not stored. Items referred to across shards have a global id,
+    (shard, number), and the global ids of removed items go to `removed` so
+    that the other shards can drop the justifications involving them.
+    """
+    def __init__(self, index, count):
+        super(_Shard, self).__init__([], [])
+        self.index = index
+        self.count = count
+        self.outbox = []
+        self.removed = []
+        self._gids = {}
+        self._objects = {}
+        self._next = 0
+        self._stamps = {}
+        self._clock = 0
+        self._sequence = 0
+
+    def kb_add(self, fact_rule):
+        """Add a fact or rule inferred here if it belongs to this shard, and
+            send it to its shard otherwise. Facts and rules whose (first LHS)
+            statement starts with a variable belong to every shard.
+        """
+        statement = fact_rule.statement if isinstance(fact_rule, Fact) else fact_rule.lhs[0]
+        target = _route(statement, self.count)
+        if target != self.index:
+            self.outbox.append((target, self._pack(fact_rule)))
+            if target is not None:
+                return
+        super(_Shard, self).kb_add(fact_rule)
+
+    def _store(self, fact_rule):
+        stored = super(_Shard, self)._store(fact_rule)
+        if stored and isinstance(fact_rule, Fact):
+            self._sequence += 1
+            self._stamps[id(fact_rule)] = (self._clock, self.index, self._sequence)
+        return stored
+
+    def _remove_all(self, facts_rules):
+        for fact_rule in facts_rules:
+            self._stamps.pop(id(fact_rule), None)
+            gid = self._gids.pop(id(fact_rule), None)
+            if gid is not None:
+                del self._objects[gid]
+                self.removed.append(gid)
+        super(_Shard, self)._remove_all(facts_rules)
+
+    def _gid(self, fact_rule):
+        """Global id of a stored fact or rule or of a stub"""
+        gid = self._gids.get(id(fact_rule))
+        if gid is None:
+            gid = (self.index, self._next)
+            self._next += 1
+            self._gids[id(fact_rule)] = gid
+            self._objects[gid] = fact_rule
+        return gid
+
+    def _pack(self, fact_rule):
+        """Record of a fact or rule and its justifications, see `_unpack`"""
+        return (wal.encode(wal.ASSERT, fact_rule),
+                [[(self._gid(x), wal.encode(wal.ASSERT, x)) for x in justification]
+                 for justification in fact_rule.supported_by])
+
+    def _unpack(self, payload, justifications):
+        """Fact or rule sent by `_pack` on another shard (or asserted, without
+            justifications), its supporters being local items or stubs
+        """
+        fact_rule = wal.decode(payload)[1]
+        for justification in justifications:
+            fact_rule.supported_by.add([self._resolve(gid, x) for gid, x in justification])
+        fact_rule.asserted = not justifications
+        return fact_rule
+
+    def _resolve(self, gid, payload):
+        """Item with a global id, making a stub if it is not known here"""
+        fact_rule = self._objects.get(gid)
+        if fact_rule is None:
+            fact_rule = wal.decode(payload)[1]
+            self._objects[gid] = fact_rule
+            self._gids[id(fact_rule)] = gid
+        return fact_rule
+
+    def _forget(self, gid):
+        """Truth maintenance for an item of another shard that was removed"""
+        stub = self._objects.pop(gid, None)
+        if stub is None:
+            return
+        del self._gids[id(stub)]
+        self._remove_all(self._unsupported_closure([stub]))
+
+    def handle(self, clock, messages):
+        """Process the messages of a round
+
+        Returns:
+            (list, list, list): the outbox, the global ids of removed items and
+                the stamped facts answering 'ask' and 'facts' messages
+        """
+        self._clock = clock
+        answers = []
+        for message in messages:
+            if message[0] == 'add':
+                KnowledgeBase.kb_add(self, self._unpack(message[1], message[2]))
+            elif message[0] == 'retract':
+                self._retract([wal.decode(message[1])[1]])
+            elif message[0] == 'forget':
+                self._forget(message[1])
+            elif message[0] == 'ask':
+                statement = wal.decode(message[1])[1].statement
+                for bindings, facts in self.kb_ask_iter(statement):
+                    answers.append((self._stamps[id(facts[0])], wal.encode(wal.ASSERT, facts[0])))
+            elif message[0] == 'facts':
+                for fact in self._facts:
+                    answers.append((self._stamps[id(fact)], wal.encode(wal.ASSERT, fact)))
+        outbox, removed = self.outbox, self.removed
+        self.outbox, self.removed = [], []
+        return outbox, removed, answers
+
+def _serve(connection, index, count):
+    """INTERNAL USE ONLY
+    Main loop of a worker process: handle the rounds sent by the coordinator
+    until it sends None
+    """
+    shard = _Shard(index, count)
+    while True:
+        command = connection.recv()
+        if command is None:
+            break
+        try:
+            connection.send((None, shard.handle(*command)))
+        except Exception as error:
+            connection.send((error, None))
+    connection.close()
+
+
+class ShardedKnowledgeBase(object):
+    """KnowledgeBase partitioned across worker processes, each running its own
+        KnowledgeBase. Facts are hash-partitioned by predicate and first term,
+        those whose first term is a variable going to every shard. A rule goes
+        to the shard owning the facts its first LHS statement matches, or to
+        every shard if that statement starts with a variable, so a curried
+        rule is sent to the shard owning its join key. Facts and
+        rules inferred on one shard for another are routed by this
+        coordinator in rounds until nothing is left to route; justifications
+        crossing shards refer to global ids, so retraction works across shards.
+        Queries are scattered to the shards that may hold answers and the
+        answers gathered in the order the facts were stored.
+
+    Attributes:
+        count (int): number of shards
+    """
+    def __init__(self, shards=2):
+        """Constructor for ShardedKnowledgeBase, starting the worker processes
+
+        Args:
+            shards (int): number of shards
+        """
+        super(ShardedKnowledgeBase, self).__init__()
+        self.count = shards
+        self._clock = 0
+        self._connections = []
+        self._processes = []
+        for index in range(shards):
+            connection, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_serve, args=(child, index, shards))
+            process.daemon = True
+            process.start()
+            child.close()
+            self._connections.append(connection)
+            self._processes.append(process)
+
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return 'ShardedKnowledgeBase({} shards)'.format(self.count)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Stop the worker processes
+        """
+        for connection, process in zip(self._connections, self._processes):
+            if process.is_alive():
+                connection.send(None)
+            process.join()
+            connection.close()
+        self._connections, self._processes = [], []
+
+    def _targets(self, statement):
+        """INTERNAL USE ONLY
+        Shards holding the facts a statement matches
+        """
+        target = _route(statement, self.count)
+        return list(range(self.count)) if target is None else [target]
+
+    def _call(self, batches):
+        """INTERNAL USE ONLY
+        Run a round: send each shard its messages, all shards working at once,
+        then gather the results in shard order
+
+        Returns:
+            listof (int, (list, list, list)): shard and result of `_Shard.handle`
+        """
+        self._clock += 1
+        shards = sorted(batches)
+        for shard in shards:
+            self._connections[shard].send((self._clock, batches[shard]))
+        results = []
+        for shard in shards:
+            error, result = self._connections[shard].recv()
+            if error is not None:
+                raise error
+            results.append((shard, result))
+        return results
+
+    def _settle(self, batches):
+        """INTERNAL USE ONLY
+        Run rounds until the shards have nothing left to route: the facts and
+        rules each shard inferred for others, and the global ids of the items
+        it removed
+        """
+        while batches:
+            results = self._call(batches)
+            batches = {}
+            for origin, (outbox, removed, answers) in results:
+                others = [shard for shard in range(self.count) if shard != origin]
+                for target, (payload, justifications) in outbox:
+                    for shard in (others if target is None else [target]):
+                        batches.setdefault(shard, []).append(('add', payload, justifications))
+                for gid in removed:
+                    for shard in others:
+                        batches.setdefault(shard, []).append(('forget', gid))
+
+    def _gather(self, batches):
+        """INTERNAL USE ONLY
+        Run a query round and merge the stamped facts of the shards in the
+        order they were stored. Facts starting with a variable are on every
+        shard, only their first copy is kept.
+        """
+        answers = []
+        for shard, (outbox, removed, stamped) in self._call(batches):
+            answers.extend(stamped)
+        answers.sort(key=lambda answer: answer[0])
+        facts, seen = [], set()
+        for stamp, payload in answers:
+            fact = wal.decode(payload)[1]
+            if fact not in seen:
+                seen.add(fact)
+                facts.append(fact)
+        return facts
+
+    def _batches(self, items, operation):
+        """INTERNAL USE ONLY
+        Messages sending facts and rules to the shards they belong to
+        """
+        batches = {}
+        for item in items:
+            if isinstance(item, Fact):
+                targets = self._targets(item.statement)
+            elif isinstance(item, Rule):
+                targets = self._targets(item.lhs[0])
+            else:
+                continue
+            payload = wal.encode(wal.ASSERT, item)
+            for shard in targets:
+                message = ('add', payload, []) if operation == wal.ASSERT else ('retract', payload)
+                batches.setdefault(shard, []).append(message)
+        return batches
+
+    @property
+    def facts(self):
+        """listof Fact: copies of the facts of every shard in the order they
+            were stored
+        """
+        return self._gather(dict((shard, [('facts',)]) for shard in range(self.count)))
+
+    def kb_assert(self, fact_rule):
+        """Assert a fact or rule, returning once every shard is done inferring
+
+        Args:
+            fact_rule (Fact|Rule): fact or rule to assert
+        """
+        printv("Asserting {!r}", 0, verbose, [fact_rule])
+        self._settle(self._batches([fact_rule], wal.ASSERT))
+
+    def bulk_load(self, items):
+        """Assert many facts and rules, sending each shard its own in one round
+
+        Args:
+            items (listof Fact|Rule): facts and rules to assert; anything else
+                is ignored
+        """
+        printv("Bulk loading {} items", 0, verbose, [len(items)])
+        self._settle(self._batches(items, wal.ASSERT))
+
+    def kb_retract(self, fact_or_rule):
+        """Retract a fact or rule as KnowledgeBase.kb_retract does, the facts and
+            rules of other shards it supported included
+
+        Args:
+            fact_or_rule (Fact|Rule): fact or rule to retract
+        """
+        printv("Retracting {!r}", 0, verbose, [fact_or_rule])
+        self._settle(self._batches([fact_or_rule], wal.RETRACT))
+
+    def kb_ask(self, fact):
+        """Ask if a fact is in the KB, scattering the query to the shards that
+            may hold answers, i.e. every shard if its first term is a variable
+
+        Args:
+            fact (Fact|Statement): statement to be asked
+
+        Returns:
+            ListOfBindings|[]: bindings of the query's variables with copies of
+                the matching facts, in the order the facts were stored
+        """
+        statement = fact.statement if factq(fact) else fact
+        printv("Asking {!r}", 0, verbose, [statement])
+        payload = wal.encode(wal.ASSERT, Fact(statement))
+        facts = self._gather(dict((shard, [('ask', payload)]) for shard in self._targets(statement)))
+        bindings_lst = ListOfBindings()
+        for kbfact in facts:
+            bindings_lst.add_bindings(match(statement, kbfact.statement), [kbfact])
+        return bindings_lst if bindings_lst.list_of_bindings else []
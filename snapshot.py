@@ -0,0 +1,181 @@
+import struct, sys
+from array import array
+from logical_classes import *
+
+# File layout, all integers little-endian:
+#   header: magic, version, number of symbols, then the length in bytes of the
+#       symbol names and the number of ints of the fact, rule and support arrays
+#   symbol name lengths (uint32 each), then the UTF-8 symbol names
+#   facts: flags, length of the key, key (symbol indexes) for each fact
+#   rules: flags, number of LHS statements, then length and key of each LHS
+#       statement and of the RHS, for each rule
+#   supports: for each fact then rule, its number of justifications, then the
+#       length and item indexes (facts first, then rules) of each of them
+MAGIC = b'KBSNAP\x00\x01'
+VERSION = 1
+_HEADER = struct.Struct('<8sIIIIII')
+
+ASSERTED = 1
+PARTIAL = 2
+
+def _dump(values, typecode):
+    """INTERNAL USE ONLY
+    Little-endian bytes of an array of ints
+    """
+    data = array(typecode, values)
+    if sys.byteorder == 'big':
+        data.byteswap()
+    return data.tobytes()
+
+def _undump(data, typecode):
+    """INTERNAL USE ONLY
+    Array of ints from little-endian bytes
+    """
+    values = array(typecode)
+    values.frombytes(data)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+def save_snapshot(kb, path):
+    """Write the facts, rules and support graph of a KnowledgeBase to a binary
+        snapshot file. Curried rules kept in the join memory of the engine are
+        saved too. Justifications involving a fact or rule no longer in the KB
+        (e.g. a retracted rule) are left out.
+
+    Args:
+        kb (KnowledgeBase): KB to save, not in the middle of forward chaining
+        path (str): name of the snapshot file
+    """
+    facts = kb.facts
+    partials = kb.ie.partial_rules() if hasattr(kb.ie, 'partial_rules') else []
+    stored = kb.rules
+    rules = stored + partials
+    index = {}
+    for item in facts + rules:
+        index[id(item)] = len(index)
+
+    symbols = {}
+    def key(statement):
+        return [symbols.setdefault(sid, len(symbols)) for sid in statement.key]
+
+    fact_ints = []
+    for fact in facts:
+        statement = key(fact.statement)
+        fact_ints.append(ASSERTED if fact.asserted else 0)
+        fact_ints.append(len(statement))
+        fact_ints.extend(statement)
+    rule_ints = []
+    for position, rule in enumerate(rules):
+        flags = ASSERTED if rule.asserted else 0
+        if position >= len(stored):
+            flags |= PARTIAL
+        rule_ints.extend((flags, len(rule.lhs)))
+        for statement in rule.lhs + [rule.rhs]:
+            statement = key(statement)
+            rule_ints.append(len(statement))
+            rule_ints.extend(statement)
+    support_ints = []
+    for item in facts + rules:
+        justifications = [justification for justification in item.supported_by
+                          if all(id(x) in index for x in justification)]
+        support_ints.append(len(justifications))
+        for justification in justifications:
+            support_ints.append(len(justification))
+            support_ints.extend(index[id(x)] for x in justification)
+
+    names = [symbol(sid).element.encode('utf-8') for sid in sorted(symbols, key=symbols.get)]
+    blob = b''.join(names)
+    with open(path, 'wb') as f:
+        f.write(_HEADER.pack(MAGIC, VERSION, len(names), len(blob),
+                             len(fact_ints), len(rule_ints), len(support_ints)))
+        f.write(_dump([len(name) for name in names], 'I'))
+        f.write(blob)
+        f.write(_dump(fact_ints, 'i'))
+        f.write(_dump(rule_ints, 'i'))
+        f.write(_dump(support_ints, 'i'))
+
+def load_snapshot(kb, path):
+    """Restore a snapshot written by `save_snapshot` into an empty KB. Facts,
+        rules and supports are stored as they were, without inferring anything;
+        the engine then rebuilds its own state through its `restore` hook.
+
+    Args:
+        kb (KnowledgeBase): empty KB to restore into
+        path (str): name of the snapshot file
+
+    Raises:
+        ValueError: if the file is not a snapshot
+    """
+    with open(path, 'rb') as f:
+        data = memoryview(f.read())
+    if len(data) < _HEADER.size:
+        raise ValueError("{!r} is not a KnowledgeBase snapshot".format(path))
+    magic, version, nsymbols, blob_size, nfacts, nrules, nsupports = \
+        _HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("{!r} is not a KnowledgeBase snapshot".format(path))
+    offset = _HEADER.size
+    def take(size):
+        nonlocal offset
+        chunk = data[offset:offset + size]
+        offset += size
+        return chunk
+    lengths = _undump(take(4 * nsymbols), 'I')
+    blob = take(blob_size)
+    ids = []
+    position = 0
+    for length in lengths:
+        ids.append(symbol_id(bytes(blob[position:position + length]).decode('utf-8')))
+        position += length
+    fact_ints = _undump(take(4 * nfacts), 'i')
+    rule_ints = _undump(take(4 * nrules), 'i')
+    support_ints = _undump(take(4 * nsupports), 'i')
+
+    def statement(ints, position):
+        length = ints[position]
+        key = tuple([ids[i] for i in ints[position + 1:position + 1 + length]])
+        return Statement.from_key(key), position + 1 + length
+
+    items = []
+    position = 0
+    while position < len(fact_ints):
+        flags = fact_ints[position]
+        fact_statement, position = statement(fact_ints, position + 1)
+        fact = Fact(fact_statement)
+        fact.asserted = bool(flags & ASSERTED)
+        kb._facts.add(fact)
+        items.append(fact)
+    partials = []
+    position = 0
+    while position < len(rule_ints):
+        flags, count = rule_ints[position], rule_ints[position + 1]
+        position += 2
+        lhs = []
+        for _ in range(count):
+            lhs_statement, position = statement(rule_ints, position)
+            lhs.append(lhs_statement)
+        rhs, position = statement(rule_ints, position)
+        rule = Rule([lhs, rhs])
+        rule.asserted = bool(flags & ASSERTED)
+        if flags & PARTIAL and getattr(kb.ie, 'join_memory', False):
+            partials.append(rule)
+        else:
+            kb._rules.append(rule)
+            kb._index_rule(rule)
+        items.append(rule)
+    position = 0
+    for item in items:
+        count = support_ints[position]
+        position += 1
+        for _ in range(count):
+            length = support_ints[position]
+            justification = [items[i] for i in support_ints[position + 1:position + 1 + length]]
+            position += 1 + length
+            item.supported_by.add(justification)
+        kb._link(item, item.supported_by)
+    for rule in partials:
+        kb.ie._keep(rule)
+    restore = getattr(kb.ie, 'restore', None)
+    if restore is not None:
+        restore(kb)
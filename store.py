@@ -0,0 +1,385 @@
+import heapq
+from logical_classes import symbol_id
+
+class _Entry(object):
+    """INTERNAL USE ONLY
+    Slot of a fact in the ordered lists of a FactStore. Removing a fact only
+        clears `alive` so that removal is O(1) and running iterations stay valid.
+        `born` and `died` are the store versions at which the fact was added
+        and removed, for views of older versions.
+    """
+    __slots__ = ('fact', 'alive', 'born', 'died')
+
+    def __init__(self, fact, born):
+        self.fact = fact
+        self.alive = True
+        self.born = born
+        self.died = None
+
+
+def _bucket(by_predicate, by_argument, key):
+    """INTERNAL USE ONLY
+    Smallest index list holding every entry that may match a statement key:
+    the predicate bucket, or the bucket of one of its constant argument
+    positions
+
+    Returns:
+        (list, int, bool): the bucket, its argument position (0 for the
+            predicate bucket) and whether the key is ground
+    """
+    predicate = key[0]
+    best = by_predicate.get(predicate, ())
+    best_position = 0
+    ground = True
+    for position in range(1, len(key)):
+        if key[position] < 0:
+            ground = False
+            continue
+        bucket = by_argument.get((predicate, position, key[position]), ())
+        if len(bucket) < len(best):
+            best, best_position = bucket, position
+    return best, best_position, ground
+
+def _with_open(entries, position, open_entries):
+    """INTERNAL USE ONLY
+    Merge in insertion order the entries of an index bucket (or of a ground
+    lookup, position None) with the entries of facts holding a variable that
+    may match too but are not in it, i.e. those with a variable at the
+    bucket's argument position (all of them for a ground lookup)
+    """
+    if position == 0 or not open_entries:
+        return entries
+    if position is not None:
+        open_entries = [e for e in open_entries if e.fact.statement.key[position] < 0]
+        if not open_entries:
+            return entries
+    return heapq.merge(entries, open_entries, key=lambda entry: entry.born)
+
+
+class FactStore(object):
+    """Hash-indexed store of the facts of a KnowledgeBase. Facts are kept in
+        insertion order next to a hash map from statement key to fact (dedup
+        and lookup), a secondary index from predicate to facts and an
+        argument-position index from (predicate, position, constant) to facts.
+        Facts holding a variable, e.g. (likes ?x pizza), are also kept per
+        predicate so that lookups by constant still find them.
+
+    Attributes:
+        compact_threshold (int): number of removed entries tolerated before the
+            ordered lists are rebuilt without them
+        version (int): number of changes made to the store, see `view`
+    """
+    compact_threshold = 64
+
+    def __init__(self, facts=[]):
+        """Constructor for FactStore
+
+        Args:
+            facts (listof Fact): facts to store initially, in order
+        """
+        super(FactStore, self).__init__()
+        self._entries = []
+        self._by_key = {}
+        self._by_predicate = {}
+        self._by_argument = {}
+        self._open = {}
+        self._dead = 0
+        self.version = 0
+        for fact in facts:
+            self.add(fact)
+
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return 'FactStore({!r})'.format(list(self))
+
+    def __len__(self):
+        """Define behavior of len, i.e. number of facts in the store
+        """
+        return len(self._by_key)
+
+    def __iter__(self):
+        """Iterate over the stored facts in insertion order
+        """
+        return self._iter_entries(self._entries)
+
+    def __contains__(self, fact):
+        """Define behavior of `in`, i.e. whether an equal fact is stored
+        """
+        return fact.statement.key in self._by_key
+
+    def _iter_entries(self, entries):
+        """INTERNAL USE ONLY
+        Yield the facts of the live entries in the given list
+        """
+        for entry in entries:
+            if entry.alive:
+                yield entry.fact
+
+    def get(self, fact):
+        """Get the stored fact that is the same as the fact argument
+
+        Args:
+            fact (Fact|Statement): fact (or statement) we're searching for
+
+        Returns:
+            Fact|None: matching fact, None if there is none
+        """
+        statement = fact.statement if hasattr(fact, 'statement') else fact
+        entry = self._by_key.get(statement.key)
+        return entry.fact if entry else None
+
+    def with_predicate(self, predicate):
+        """Iterate in insertion order over the facts having the given predicate
+
+        Args:
+            predicate (str): predicate of the facts, e.g. 'isa'
+
+        Returns:
+            iterator of Fact
+        """
+        return self._iter_entries(self._by_predicate.get(symbol_id(predicate), ()))
+
+    def candidates(self, statement):
+        """Iterate in insertion order over the facts that may match the given
+            statement. A ground statement is a single hash lookup; otherwise the
+            smallest of the buckets of its constant argument positions is used,
+            falling back to the predicate bucket when every term is a variable.
+            Facts of the predicate holding a variable that may unify with the
+            statement are added in. Candidates agree with the statement on one
+            position at most, so they still have to be checked with
+            `util.match`.
+
+        Args:
+            statement (Statement): pattern to find candidate facts for
+
+        Returns:
+            iterator of Fact
+        """
+        key = statement.key
+        best, position, ground = _bucket(self._by_predicate, self._by_argument, key)
+        open_entries = self._open.get(key[0])
+        if ground:
+            entry = self._by_key.get(key)
+            if not open_entries:
+                return iter((entry.fact,)) if entry else iter(())
+            best, position = [entry] if entry else [], None
+        return self._iter_entries(_with_open(best, position, open_entries))
+
+    def estimate(self, statement):
+        """Upper bound of the number of facts matching a statement, i.e. the
+            size of the index bucket `candidates` would scan
+
+        Args:
+            statement (Statement): pattern to estimate
+
+        Returns:
+            int
+        """
+        key = statement.key
+        best, position, ground = _bucket(self._by_predicate, self._by_argument, key)
+        extra = len(self._open.get(key[0], ())) if ground or position else 0
+        if ground:
+            return (1 if key in self._by_key else 0) + extra
+        return len(best) + extra
+
+    def add(self, fact):
+        """Add a fact unless an equal one is already stored
+
+        Args:
+            fact (Fact): fact to add
+
+        Returns:
+            bool: True if the fact was added, False if already stored
+        """
+        key = fact.statement.key
+        if key in self._by_key:
+            return False
+        self.version += 1
+        entry = _Entry(fact, self.version)
+        self._by_key[key] = entry
+        self._entries.append(entry)
+        self._index(entry)
+        return True
+
+    def remove(self, fact):
+        """Remove the stored fact equal to the given one
+
+        Args:
+            fact (Fact): fact to remove
+
+        Returns:
+            Fact|None: the removed fact, None if it was not stored
+        """
+        removed = self.remove_many([fact])
+        return removed[0] if removed else None
+
+    def remove_many(self, facts):
+        """Remove the stored facts equal to the given ones, rebuilding the
+            ordered lists at most once
+
+        Args:
+            facts (listof Fact): facts to remove
+
+        Returns:
+            listof Fact: the removed facts, in order, without the ones not stored
+        """
+        removed = []
+        version = self.version + 1
+        for fact in facts:
+            entry = self._by_key.pop(fact.statement.key, None)
+            if entry is None:
+                continue
+            entry.alive = False
+            entry.died = self.version = version
+            self._dead += 1
+            removed.append(entry.fact)
+        if self._dead > self.compact_threshold and self._dead > len(self._by_key):
+            self._compact()
+        return removed
+
+    def _compact(self):
+        """INTERNAL USE ONLY
+        Rebuild the ordered lists without removed entries. New lists are built
+        so that iterations already running over the old ones, and views holding
+        them, are unaffected.
+        """
+        entries = [e for e in self._entries if e.alive]
+        self._entries = entries
+        self._by_predicate = {}
+        self._by_argument = {}
+        self._open = {}
+        for entry in entries:
+            self._index(entry)
+        self._dead = 0
+
+    def view(self):
+        """Read-only view of the store as it is now, unaffected by later
+            changes. Taking it is O(1): it shares the ordered lists, which are
+            only ever appended to (compaction builds new ones), and keeps the
+            entries that were alive at the current version.
+
+        Returns:
+            FactStoreView
+        """
+        return FactStoreView(self)
+
+    def _index(self, entry):
+        """INTERNAL USE ONLY
+        Append an entry to its predicate bucket and argument-position buckets,
+        and to the bucket of facts holding a variable if it does
+        """
+        key = entry.fact.statement.key
+        predicate = key[0]
+        self._by_predicate.setdefault(predicate, []).append(entry)
+        if len(key) > 1 and min(key[1:]) < 0:
+            self._open.setdefault(predicate, []).append(entry)
+        by_argument = self._by_argument
+        for position in range(1, len(key)):
+            index_key = (predicate, position, key[position])
+            bucket = by_argument.get(index_key)
+            if bucket is None:
+                by_argument[index_key] = [entry]
+            else:
+                bucket.append(entry)
+
+
+class FactStoreView(object):
+    """Read-only view of a FactStore at a given version, answering the queries
+        of a FactStore as they would have been answered at that version.
+        Ground lookups scan the smallest index bucket instead of using the hash
+        map from statement key, which only holds the current facts.
+
+    Attributes:
+        version (int): version of the store seen by the view
+    """
+    def __init__(self, store):
+        """Constructor for FactStoreView
+
+        Args:
+            store (FactStore): store to view, at its current version
+        """
+        super(FactStoreView, self).__init__()
+        self.version = store.version
+        self._entries = store._entries
+        self._by_predicate = store._by_predicate
+        self._by_argument = store._by_argument
+        self._open = store._open
+
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return 'FactStoreView({!r})'.format(list(self))
+
+    def __len__(self):
+        """Define behavior of len, i.e. number of facts in the view
+        """
+        return sum(1 for _ in self)
+
+    def __iter__(self):
+        """Iterate over the facts of the view in insertion order
+        """
+        return self._iter_entries(self._entries)
+
+    def __contains__(self, fact):
+        """Define behavior of `in`, i.e. whether an equal fact is in the view
+        """
+        return self.get(fact) is not None
+
+    def _iter_entries(self, entries):
+        """INTERNAL USE ONLY
+        Yield the facts of the entries in the given list visible in the view
+        """
+        version = self.version
+        for entry in entries:
+            if entry.born > version:
+                # lists are in insertion order, everything after is newer
+                return
+            if entry.died is None or entry.died > version:
+                yield entry.fact
+
+    def get(self, fact):
+        """Get the fact of the view that is the same as the fact argument
+
+        Args:
+            fact (Fact|Statement): fact (or statement) we're searching for
+
+        Returns:
+            Fact|None: matching fact, None if there is none
+        """
+        statement = fact.statement if hasattr(fact, 'statement') else fact
+        key = statement.key
+        best = _bucket(self._by_predicate, self._by_argument, key)[0]
+        for kbfact in self._iter_entries(best):
+            if kbfact.statement.key == key:
+                return kbfact
+        return None
+
+    def with_predicate(self, predicate):
+        """See FactStore.with_predicate
+        """
+        return self._iter_entries(self._by_predicate.get(symbol_id(predicate), ()))
+
+    def candidates(self, statement):
+        """See FactStore.candidates
+        """
+        key = statement.key
+        best, position, ground = _bucket(self._by_predicate, self._by_argument, key)
+        open_entries = self._open.get(key[0])
+        if ground:
+            fact = self.get(statement)
+            if not open_entries:
+                return iter((fact,)) if fact else iter(())
+            best = [e for e in best if e.fact is fact] if fact else []
+            position = None
+        return self._iter_entries(_with_open(best, position, open_entries))
+
+    def estimate(self, statement):
+        """See FactStore.estimate
+        """
+        key = statement.key
+        best, position, ground = _bucket(self._by_predicate, self._by_argument, key)
+        extra = len(self._open.get(key[0], ())) if ground or position else 0
+        if ground:
+            return (1 if self.get(statement) else 0) + extra
+        return len(best) + extra
@@ -12,15 +12,17 @@ def is_var(var):
         bool
     """
     if type(var) == str:
-        return var[0] == "?"
+        return var.startswith("?")
     if isinstance(var, lc.Term):
-        return isinstance(var.term, lc.Variable)
+        return var.id < 0
 
     return isinstance(var, lc.Variable)
 
 def match(state1, state2, bindings=None):
     """Match two statements and return the associated bindings or False if there
-        is no binding
+        is no binding. Matching a pattern against a ground statement without
+        prior bindings, as `kb_ask` and `fc_infer` do, uses the compiled form
+        of the pattern (see `compile_pattern`).
 
     Args:
         state1 (Statement): statement to match with state2
@@ -30,14 +32,18 @@ def match(state1, state2, bindings=None):
     Returns:
         Bindings|False: either associated bindings or no match found
     """
-    if len(state1.terms) != len(state2.terms) or state1.predicate != state2.predicate:
+    key1, key2 = state1.key, state2.key
+    if len(key1) != len(key2) or key1[0] != key2[0]:
         return False
     if not bindings:
+        if len(key2) == 1 or min(key2[1:]) >= 0:
+            return compile_pattern(state1).bindings(key2) or False
         bindings = lc.Bindings()
     return match_recursive(state1.terms, state2.terms, bindings)
 
-def match_recursive(terms1, terms2, bindings):  # recursive...
-    """Recursive helper for match
+def match_recursive(terms1, terms2, bindings):
+    """Helper for match unifying two lists of terms pairwise. Despite its name
+        it walks the terms in a loop, without recursion or slicing.
 
     Args:
         terms1 (listof Term): terms to match with terms2
@@ -47,17 +53,266 @@ def match_recursive(terms1, terms2, bindings):  # recursive...
     Returns:
         Bindings|False: either associated bindings or no match found
     """
-    if len(terms1) == 0:
-        return bindings
-    if is_var(terms1[0]):
-        if not bindings.test_and_bind(terms1[0], terms2[0]):
+    for term1, term2 in zip(terms1, terms2):
+        if term1.id < 0:
+            if not bindings.test_and_bind(term1, term2):
+                return False
+        elif term2.id < 0:
+            if not bindings.test_and_bind(term2, term1):
+                return False
+        elif term1 is not term2:
             return False
-    elif is_var(terms2[0]):
-        if not bindings.test_and_bind(terms2[0], terms1[0]):
-            return False
-    elif terms1[0] != terms2[0]:
-        return False
-    return match_recursive(terms1[1:], terms2[1:], bindings)
+    return bindings
+
+class Pattern(object):
+    """Statement compiled once for matching against ground statements. Matching
+        runs over the flat key of the ground statement: constant checks first,
+        then checks of repeated variables, and only a successful match allocates
+        the tuple of the values bound to the variables.
+
+    Attributes:
+        length (int): length of the keys that can match
+        constants (tupleof (int, int)): (position, symbol id) of the predicate
+            and constant terms, positions being indexes into `Statement.key`
+        repeats (tupleof (int, int)): (position, position of first occurrence)
+            of every repeated variable
+        slots (tupleof int): position of the first occurrence of each distinct
+            variable; a match returns the symbol ids found there, in this order
+        variables (tupleof Variable): the variable of each slot
+        slot_of (dictof int): slot of each variable keyed by its symbol id
+    """
+    __slots__ = ('length', 'constants', 'repeats', 'slots', 'variables',
+                 'slot_of')
+
+    def __init__(self, statement):
+        """Constructor for Pattern
+
+        Args:
+            statement (Statement): statement to compile, variables included
+        """
+        key = statement.key
+        constants = [(0, key[0])]
+        repeats = []
+        first = {}
+        for position in range(1, len(key)):
+            symbol = key[position]
+            if symbol >= 0:
+                constants.append((position, symbol))
+            elif symbol in first:
+                repeats.append((position, first[symbol]))
+            else:
+                first[symbol] = position
+        self.length = len(key)
+        self.constants = tuple(constants)
+        self.repeats = tuple(repeats)
+        self.slots = tuple(first.values())
+        self.variables = tuple(lc.symbol(symbol) for symbol in first)
+        self.slot_of = dict((symbol, slot) for slot, symbol in enumerate(first))
+
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return 'Pattern({!r}, {!r}, {!r}, {!r})'.format(
+            self.constants, self.repeats, self.slots, self.variables)
+
+    def match(self, key):
+        """Match the key of a ground statement
+
+        Args:
+            key (tupleof int): `Statement.key` of a ground statement
+
+        Returns:
+            tupleof int|None: symbol ids bound to the slots, None if no match
+        """
+        if len(key) != self.length:
+            return None
+        for position, symbol in self.constants:
+            if key[position] != symbol:
+                return None
+        for position, first in self.repeats:
+            if key[position] != key[first]:
+                return None
+        return tuple([key[position] for position in self.slots])
+
+    def bindings(self, key):
+        """Match the key of a ground statement and return Bindings
+
+        Args:
+            key (tupleof int): `Statement.key` of a ground statement
+
+        Returns:
+            Bindings|None: bindings of the variables, None if no match
+        """
+        values = self.match(key)
+        if values is None:
+            return None
+        return lc.Bindings(self.variables, list(values), self.slot_of)
+
+_patterns = {}
+
+def compile_pattern(statement):
+    """Get the compiled Pattern of a statement, compiling it on first use
+
+    Args:
+        statement (Statement): statement to compile
+
+    Returns:
+        Pattern
+    """
+    pattern = _patterns.get(statement)
+    if pattern is None:
+        if len(_patterns) >= 65536:
+            _patterns.clear()
+        pattern = _patterns[statement] = Pattern(statement)
+    return pattern
+
+class CompiledRule(object):
+    """Rule compiled once into templates over variable slots. Slots number the
+        distinct variables of the rule in order of first occurrence over the LHS
+        statements then the RHS, so the values a fact binds to the variables of
+        the first LHS statement (see `Pattern.match`) are the values of the
+        first slots. Firing the rule fills templates with these values instead
+        of building bindings and instantiating statements, and the rule curried
+        by a fact is compiled by specializing this one.
+
+    Attributes:
+        variables (tupleof int): symbol id of the variable of each slot
+        premises (tupleof tupleof (int|None, int)): template of each LHS
+            statement, i.e. the (slot, symbol id) at each position of its key,
+            slot being None for the predicate and the constants
+        rhs (tupleof (int|None, int)): template of the RHS statement
+        first (Pattern): compiled first LHS statement
+    """
+    __slots__ = ('variables', 'premises', 'rhs', 'first')
+
+    def __init__(self, variables, premises, rhs, first=None):
+        """Constructor for CompiledRule
+
+        Args:
+            variables (tupleof int): symbol id of the variable of each slot
+            premises (tupleof tupleof (int|None, int)): LHS templates
+            rhs (tupleof (int|None, int)): RHS template
+            first (Statement|None): first LHS statement, built from its
+                template if not given
+        """
+        self.variables = variables
+        self.premises = premises
+        self.rhs = rhs
+        if first is None:
+            first = self.statement(premises[0])
+        self.first = compile_pattern(first)
+
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return 'CompiledRule({!r}, {!r}, {!r})'.format(
+            self.variables, self.premises, self.rhs)
+
+    def fill(self, template, values=()):
+        """Fill a template with the values of the first slots, leaving the
+            other slots as variables
+
+        Args:
+            template (tupleof (int|None, int)): template to fill
+            values (tupleof int): symbol ids of the first slots
+
+        Returns:
+            tupleof int: `Statement.key` of the filled template
+        """
+        bound = len(values)
+        return tuple([symbol if slot is None or slot >= bound else values[slot]
+                      for slot, symbol in template])
+
+    def statement(self, template, values=()):
+        """Build the statement of a template filled with the values of the
+            first slots (see `fill`)
+
+        Args:
+            template (tupleof (int|None, int)): template to fill
+            values (tupleof int): symbol ids of the first slots
+
+        Returns:
+            Statement
+        """
+        return lc.Statement.from_key(self.fill(template, values))
+
+    def curry(self, values):
+        """Curry the rule with the values a fact binds to the first LHS
+            statement, i.e. fill them into the other LHS statements and the RHS.
+            The curried rule is compiled on first use by `specialize`, as most
+            curried rules never fire.
+
+        Args:
+            values (tupleof int): symbol ids of the first slots, as returned by
+                `first.match`
+
+        Returns:
+            (listof Statement, Statement): LHS and RHS of the curried rule
+        """
+        lhs = tuple([self.fill(template, values) for template in self.premises[1:]])
+        rhs = self.fill(self.rhs, values)
+        key = (lhs, rhs)
+        if key not in _rules:
+            _cache_rule(key, (self, values))
+        return [lc.Statement.from_key(statement) for statement in lhs], lc.Statement.from_key(rhs)
+
+    def specialize(self, values, first=None):
+        """Compile the rule curried with the given values from this one: the
+            bound slots become constants and the remaining ones are shifted
+
+        Args:
+            values (tupleof int): symbol ids of the first slots
+            first (Statement|None): first LHS statement of the curried rule
+
+        Returns:
+            CompiledRule
+        """
+        bound = len(values)
+        def shift(template):
+            return tuple([(None, symbol) if slot is None else
+                          (None, values[slot]) if slot < bound else
+                          (slot - bound, symbol) for slot, symbol in template])
+        return CompiledRule(self.variables[bound:],
+                            tuple(shift(template) for template in self.premises[1:]),
+                            shift(self.rhs), first)
+
+_rules = {}
+
+def _cache_rule(key, compiled):
+    """INTERNAL USE ONLY
+    Cache a compiled rule, dropping the cache when it gets too big
+    """
+    if len(_rules) >= 65536:
+        _rules.clear()
+    _rules[key] = compiled
+
+def compile_rule(rule):
+    """Get the CompiledRule of a rule, compiling it on first use. Rules with the
+        same LHS and RHS share it.
+
+    Args:
+        rule (Rule): rule to compile
+
+    Returns:
+        CompiledRule
+    """
+    key = (tuple(statement.key for statement in rule.lhs), rule.rhs.key)
+    compiled = _rules.get(key)
+    if type(compiled) is tuple:
+        parent, values = compiled
+        compiled = _rules[key] = parent.specialize(values, rule.lhs[0])
+    elif compiled is None:
+        slot_of = {}
+        def template(statement):
+            return tuple([(None, symbol) if position == 0 or symbol >= 0 else
+                          (slot_of.setdefault(symbol, len(slot_of)), symbol)
+                          for position, symbol in enumerate(statement.key)])
+        premises = tuple(template(statement) for statement in rule.lhs)
+        rhs = template(rule.rhs)
+        variables = tuple(sorted(slot_of, key=slot_of.get))
+        compiled = CompiledRule(variables, premises, rhs, rule.lhs[0])
+        _cache_rule(key, compiled)
+    return compiled
 
 def instantiate(statement, bindings):
     """Generate Statement from given statement and bindings. Constructed statement
@@ -67,15 +322,15 @@ def instantiate(statement, bindings):
         statement (Statement): statement to generate new statement from
         bindings (Bindings): bindings to substitute into statement
     """
-    def handle_term(term):
-        if is_var(term):
-            bound_value = bindings.bound_to(term.term)
-            return lc.Term(bound_value) if bound_value else term
-        else:
-            return term
-
-    new_terms = [handle_term(t) for t in statement.terms]
-    return lc.Statement([statement.predicate] + new_terms)
+    key = statement.key
+    new_key = [key[0]]
+    for symbol in key[1:]:
+        if symbol < 0:
+            bound = bindings.bound_id(symbol)
+            if bound is not None:
+                symbol = bound
+        new_key.append(symbol)
+    return lc.Statement.from_key(tuple(new_key))
 
 def factq(element):
     """Check if element is a fact
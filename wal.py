@@ -0,0 +1,235 @@
+import os, struct, threading, time, zlib
+from logical_classes import *
+
+# Record layout, all integers little-endian:
+#   header: length of the payload (uint32), CRC-32 of the payload (uint32)
+#   payload: operation (uint8), number of LHS statements (uint16, 0 for a fact),
+#       then each statement (the LHS, then the RHS or the fact statement) as its
+#       number of elements (uint16) followed by each element, predicate first,
+#       as a length (uint16) and UTF-8 bytes
+ASSERT = 1
+RETRACT = 2
+_RECORD = struct.Struct('<II')
+_OPERATION = struct.Struct('<BH')
+_LENGTH = struct.Struct('<H')
+
+def encode(operation, fact_rule):
+    """Encode an assert or retract as the payload of a log record
+
+    Args:
+        operation (int): ASSERT or RETRACT
+        fact_rule (Fact|Rule): asserted or retracted fact or rule
+
+    Returns:
+        bytes
+    """
+    if isinstance(fact_rule, Fact):
+        statements = [fact_rule.statement]
+    else:
+        statements = fact_rule.lhs + [fact_rule.rhs]
+    parts = [_OPERATION.pack(operation, len(statements) - 1)]
+    for statement in statements:
+        parts.append(_LENGTH.pack(len(statement.key)))
+        for sid in statement.key:
+            data = symbol(sid).element.encode('utf-8')
+            parts.append(_LENGTH.pack(len(data)))
+            parts.append(data)
+    return b''.join(parts)
+
+def decode(payload):
+    """Decode the payload of a log record
+
+    Args:
+        payload (bytes): payload written by `encode`
+
+    Returns:
+        (int, Fact|Rule): the operation and the fact or rule
+    """
+    operation, lhs_count = _OPERATION.unpack_from(payload)
+    offset = _OPERATION.size
+    statements = []
+    for _ in range(lhs_count + 1):
+        count, = _LENGTH.unpack_from(payload, offset)
+        offset += _LENGTH.size
+        elements = []
+        for _ in range(count):
+            length, = _LENGTH.unpack_from(payload, offset)
+            offset += _LENGTH.size
+            elements.append(payload[offset:offset + length].decode('utf-8'))
+            offset += length
+        statements.append(elements)
+    if lhs_count == 0:
+        return operation, Fact(statements[0])
+    return operation, Rule([statements[:-1], statements[-1]])
+
+
+class WriteAheadLog(object):
+    """Append-only log of the asserts and retracts of a KnowledgeBase, for
+        durability between snapshots. Records are checksummed and handed to
+        the operating system as they are appended, so they survive the process
+        crashing, and made durable by group commit: a background thread issues
+        a single fsync for every record appended since the previous one.
+
+    Attributes:
+        path (str): name of the log file
+        group_size (int): number of pending records that triggers a commit
+            at once
+        interval (float): longest time in seconds a record stays pending
+            before it is committed
+    """
+    def __init__(self, path, group_size=64, interval=0.05):
+        """Constructor for WriteAheadLog, opening (or creating) the log file.
+            A torn or corrupt tail left by a crash is cut off.
+
+        Args:
+            path (str): name of the log file
+            group_size (int): see above
+            interval (float): see above
+        """
+        super(WriteAheadLog, self).__init__()
+        self.path = path
+        self.group_size = group_size
+        self.interval = interval
+        self._lock = threading.Condition(threading.Lock())
+        self._pending = 0
+        self._since = None
+        self._closed = False
+        end = self._scan()[1]
+        self._file = open(path, 'ab')
+        if self._file.tell() != end:
+            self._file.truncate(end)
+            self._file.seek(end)
+        self._syncer = threading.Thread(target=self._run)
+        self._syncer.daemon = True
+        self._syncer.start()
+
+    def __repr__(self):
+        """Define internal string representation
+        """
+        return 'WriteAheadLog({!r}, {} pending)'.format(self.path, self._pending)
+
+    def _scan(self):
+        """INTERNAL USE ONLY
+        Read the valid records of the log file, stopping at the first torn or
+        corrupt one
+
+        Returns:
+            (listof bytes, int): payloads, and offset of the end of the last
+                valid record
+        """
+        if not os.path.exists(self.path):
+            return [], 0
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        payloads = []
+        offset = 0
+        while offset + _RECORD.size <= len(data):
+            length, crc = _RECORD.unpack_from(data, offset)
+            start = offset + _RECORD.size
+            payload = data[start:start + length]
+            if len(payload) != length or zlib.crc32(payload) != crc:
+                break
+            payloads.append(payload)
+            offset = start + length
+        return payloads, offset
+
+    def records(self):
+        """Read back the records of the log
+
+        Returns:
+            listof (int, Fact|Rule): operation (ASSERT or RETRACT) and fact or
+                rule of each record, in order
+        """
+        with self._lock:
+            self._file.flush()
+        return [decode(payload) for payload in self._scan()[0]]
+
+    def append(self, operation, fact_rule):
+        """Append a record and hand it to the operating system. It is committed
+            within `interval` seconds, or at once if `group_size` records are
+            pending; call `commit` to wait until it is durable.
+
+        Args:
+            operation (int): ASSERT or RETRACT
+            fact_rule (Fact|Rule): asserted or retracted fact or rule
+        """
+        payload = encode(operation, fact_rule)
+        with self._lock:
+            self._file.write(_RECORD.pack(len(payload), zlib.crc32(payload)))
+            self._file.write(payload)
+            self._file.flush()
+            self._pending += 1
+            if self._since is None:
+                self._since = time.monotonic()
+                self._lock.notify()
+            elif self._pending >= self.group_size:
+                self._lock.notify()
+
+    def _run(self):
+        """INTERNAL USE ONLY
+        Loop of the background thread committing pending records once the
+        oldest is `interval` seconds old or `group_size` of them are pending.
+        The lock is released during the fsync, so that appends go on.
+        """
+        with self._lock:
+            while not self._closed:
+                if not self._pending:
+                    self._lock.wait()
+                    continue
+                delay = self._since + self.interval - time.monotonic()
+                if delay > 0 and self._pending < self.group_size:
+                    self._lock.wait(delay)
+                    continue
+                self._pending = 0
+                self._since = None
+                fileno = self._file.fileno()
+                self._lock.release()
+                try:
+                    os.fsync(fileno)
+                finally:
+                    self._lock.acquire()
+
+    def commit(self):
+        """Make every appended record durable, including those the background
+            thread may be committing right now
+        """
+        with self._lock:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._pending = 0
+            self._since = None
+
+    def _commit(self):
+        """INTERNAL USE ONLY
+        Flush and fsync the pending records, the lock being held
+        """
+        if self._pending:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._pending = 0
+            self._since = None
+
+    def truncate(self):
+        """Empty the log, e.g. once a snapshot holds everything it recorded
+        """
+        with self._lock:
+            self._file.truncate(0)
+            self._file.seek(0)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._pending = 0
+            self._since = None
+
+    def close(self):
+        """Commit pending records, stop the background thread and close the
+            log file
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._lock.notify()
+        self._syncer.join()
+        with self._lock:
+            self._commit()
+            self._file.close()